@@ -1,20 +1,26 @@
+import configparser
 from typing import Union
 import lib
 from main import Agent
+from src.models.lib import tracing
 
-def main(sock:Union[lib.connection.TCPServer,lib.connection.TCPClient], received:list, name:str):
-    agent = Agent(name=name)
+def main(sock:Union[lib.connection.TCPServer,lib.connection.TCPClient], inifile:configparser.ConfigParser, received:list, name:str):
+    agent = Agent(name=name, inifile=inifile)
     if received != None: agent.set_received(received=received)
 
     while agent.gameContinue:
         if len(agent.received) == 0:
-            agent.parse_info(receive=sock.receive())
+            with tracing.span("receive"):
+                agent.parse_info(receive=sock.receive())
 
-        agent.get_info()
-        message = agent.action()
+        with tracing.span("get_info"):
+            agent.get_info()
+        with tracing.span("action"):
+            message = agent.action()
 
         if message != "":
-            sock.send(message=message)
+            with tracing.span("send"):
+                sock.send(message=message)
 
     return agent.received if len(agent.received) != 0 else None
 
@@ -0,0 +1,153 @@
+import asyncio
+import configparser
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import lib
+from lib.connection import JsonFramer
+from main import Agent, shared_workers
+from src.models.lib import records, tracing
+
+logger = logging.getLogger("aiwolf.host")
+
+
+def parse_ports(spec: str) -> list[int]:
+    """Ports such as "50000-50031" or "50000, 50002"."""
+    ports = []
+    for part in spec.split(","):
+        first, _, last = part.strip().partition("-")
+        ports.extend(range(int(first), int(last or first) + 1))
+    return ports
+
+
+def agent_names(inifile: configparser.ConfigParser, count: int) -> list[str]:
+    """[agent] name1, name2, ... in order, then [host] name_prefix + number for the rest."""
+    prefix = inifile.get("host", "name_prefix", fallback="agent")
+    return [inifile.get("agent", f"name{number}", fallback=f"{prefix}{number}") for number in range(1, count + 1)]
+
+
+async def receive(reader: asyncio.StreamReader, framer: JsonFramer, size: int) -> list[str]:
+    messages = []
+    while not messages:
+        data = await reader.read(size)
+        if not data:
+            raise RuntimeError("socket connection broken")
+        messages = framer.feed(data)
+    return messages
+
+
+async def play(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    framer: JsonFramer,
+    inifile: configparser.ConfigParser,
+    received: list | None,
+    name: str,
+) -> list | None:
+    """establish.mainと同じ流れで1ゲームを行う. 接続ごとにAgentを1つ持つ"""
+    agent = Agent(name=name, inifile=inifile)
+    if received != None:
+        agent.set_received(received=received)
+    size = inifile.getint("connection", "buffer")
+    while agent.gameContinue:
+        if len(agent.received) == 0:
+            with tracing.span("receive"):
+                agent.parse_info(receive=await receive(reader, framer, size))
+
+        with tracing.span("get_info"):
+            agent.get_info()
+        with tracing.span("action"):
+            message = await agent.action_async()
+
+        if message != "":
+            with tracing.span("send"):
+                writer.write((message + "\n").encode("utf-8"))
+                await writer.drain()
+    return agent.received if len(agent.received) != 0 else None
+
+
+async def execute_game(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, inifile: configparser.ConfigParser, name: str) -> None:
+    framer = JsonFramer()
+    received = None
+    try:
+        for _ in range(inifile.getint("game", "num")):
+            received = await play(reader, writer, framer, inifile, received, name)
+    finally:
+        writer.close()
+
+
+async def accept(ip: str, port: int) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    """Wait for one connection on the port, as TCPServer does."""
+    connected = asyncio.get_running_loop().create_future()
+
+    def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if connected.done():
+            writer.close()
+        else:
+            connected.set_result((reader, writer))
+
+    server = await asyncio.start_server(on_connect, ip, port)
+    logger.info("server listening...\tip:%s port:%s", ip, port)
+    try:
+        return await connected
+    finally:
+        server.close()
+
+
+async def serve_agent(inifile: configparser.ConfigParser, name: str, port: int | None) -> None:
+    """1エージェント分の接続を続ける. 例外はここで止めて, 他のエージェントには伝えない"""
+    while True:
+        try:
+            if inifile.getboolean("connection", "host_flag"):
+                reader, writer = await accept(inifile.get("tcp-server", "ip"), port)
+            else:
+                reader, writer = await asyncio.open_connection(inifile.get("tcp-client", "host"), inifile.getint("tcp-client", "port"))
+            await execute_game(reader, writer, inifile, name)
+        except Exception as error:
+            # multiprocess.pyでそのプロセスだけが落ちていたのと同じく, このエージェントだけを打ち切る
+            logger.exception("%s (port %s): %s: %s", name, port, type(error).__name__, error)
+            records.record("error", name=name, port=port, error=repr(error))
+            if inifile.getboolean("connection", "keep_connection"):
+                # 接続先が落ちている間に繰り返し接続しにいかないよう少し待つ
+                await asyncio.sleep(1)
+
+        if not inifile.getboolean("connection", "keep_connection"):
+            break
+
+
+async def serve(inifile: configparser.ConfigParser) -> None:
+    """[host] portsの各ポートで1エージェントずつ, 全てを1つのイベントループで動かす
+
+    host_flag = falseの場合はポートの数だけ[tcp-client]へ接続する.
+    """
+    # LLMの呼び出しはスレッドで待つので, エージェントの数に合わせて増やしておく
+    workers = inifile.getint("host", "workers", fallback=64)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    ports = parse_ports(inifile.get("host", "ports"))
+    names = agent_names(inifile, len(ports))
+    logger.info("agent_num:%d", len(ports))
+    if inifile.get("agent", "execution", fallback="async") == "process":
+        # ワーカープロセスはホストで1つ. 起動とモデルの構築はループを止めないようスレッドで待つ
+        await asyncio.to_thread(shared_workers(inifile).warm)
+    await asyncio.gather(*(serve_agent(inifile, name, port) for name, port in zip(names, ports)))
+
+
+def main(inifile: configparser.ConfigParser) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if inifile.getboolean("host", "uvloop", fallback=True):
+        try:
+            import uvloop
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+    asyncio.run(serve(inifile))
+
+
+if __name__ == "__main__":
+    config_path = "./src/agent/config.ini"
+
+    inifile = lib.util.check_config(config_path=config_path)
+    inifile.read(config_path, "UTF-8")
+
+    main(inifile)
@@ -1 +1 @@
-from . import commands, connection, util
+from . import commands, connection, extractor, hedge, matcher, speculate, state, util, workers
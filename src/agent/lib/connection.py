@@ -1,28 +1,93 @@
 import os
+import re
 import socket
 import paramiko
 import configparser
-from lib import(
-    util
-)
+
+class JsonFramer:
+    """受信したバイト列から完結したJSONメッセージを順に切り出す
+
+    波括弧の深さと文字列/エスケープの状態を読み込みをまたいで保持するので,
+    各バイトは1度しか走査しない. 文字列中の波括弧は数えない.
+    """
+    # UTF-8のマルチバイト文字にASCIIのバイトは現れないので, バイト列のまま走査できる
+    TOKEN = re.compile(rb'[{}"\\]')
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.start = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = -1
+
+    def feed(self, data: bytes) -> list[str]:
+        self.buffer += data
+        messages = []
+        end = 0
+        for match in self.TOKEN.finditer(self.buffer, self.scanned):
+            index = match.start()
+            token = self.buffer[index]
+            if self.in_string:
+                if index == self.escaped:
+                    continue
+                if token == 0x5C:  # バックスラッシュ
+                    self.escaped = index + 1
+                elif token == 0x22:  # "
+                    self.in_string = False
+            elif token == 0x22:
+                self.in_string = self.depth > 0
+            elif token == 0x7B:  # {
+                if self.depth == 0:
+                    self.start = index
+                self.depth += 1
+            elif token == 0x7D and self.depth > 0:  # }
+                self.depth -= 1
+                if self.depth == 0:
+                    messages.append(self.buffer[self.start:index + 1].decode("utf-8"))
+                    end = index + 1
+        # 切り出した分は捨て, 残りは次の読み込みに回す
+        if end:
+            del self.buffer[:end]
+            self.start -= end
+            self.escaped -= end
+        self.scanned = len(self.buffer)
+        return messages
+
+
+def agent_number(inifile:configparser.ConfigParser, name:str) -> int | None:
+    """[agent]のname1..nameNのうちnameが何番目か(1始まり). 見つからなければNone"""
+    for number in range(1, inifile.getint("agent","num") + 1):
+        if inifile.get("agent","name" + str(number), fallback=None) == name:
+            return number
+    return None
+
 
 class Connection:
     def __init__(self,inifile:configparser.ConfigParser) -> None:
         self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         self.buffer = inifile.getint("connection","buffer")
-    
-    def receive(self, socket:socket.socket) -> str:
-        responses = b""
-
-        while not util.is_json_complate(responces=responses):
-            response = socket.recv(self.buffer)
-            
-            if response == b"":
+        self.chunk = bytearray(self.buffer)
+        self.framer = JsonFramer()
+
+    def receive(self, socket:socket.socket) -> list[str]:
+        messages = []
+
+        while not messages:
+            if hasattr(socket, "recv_into"):
+                size = socket.recv_into(self.chunk)
+                response = memoryview(self.chunk)[:size]
+            else:
+                # paramikoのChannelはrecv_intoを持たない
+                response = socket.recv(self.buffer)
+                size = len(response)
+
+            if size == 0:
                 raise RuntimeError("socket connection broken")
-            
-            responses += response
 
-        return responses.decode("utf-8")
+            messages = self.framer.feed(response)
+
+        return messages
     
     def send(self, socket:socket.socket, message:str) -> None:
         message += "\n"
@@ -42,7 +107,7 @@ class TCPClient(Connection):
     def connect(self) -> None:
         self.socket.connect((self.host,self.port))
     
-    def receive(self) -> str:
+    def receive(self) -> list[str]:
         return super().receive(socket=self.socket)
     
     def send(self, message:str) -> None:
@@ -60,19 +125,8 @@ class TCPServer(Connection):
         self.socket.bind((self.host_ip,self.host_port))
     
     def get_host_port(self, inifile:configparser.ConfigParser, name:str) -> int:
-
-        if name == inifile.get("agent","name1"):
-            return inifile.getint("tcp-server","port1")
-        elif name == inifile.get("agent","name2"):
-            return inifile.getint("tcp-server","port2")
-        elif name == inifile.get("agent","name3"):
-            return inifile.getint("tcp-server","port3")
-        elif name == inifile.get("agent","name4"):
-            return inifile.getint("tcp-server","port4")
-        elif name == inifile.get("agent","name5"):
-            return inifile.getint("tcp-server","port5")
-        
-        return None
+        number = agent_number(inifile=inifile, name=name)
+        return inifile.getint("tcp-server","port" + str(number)) if number is not None else None
     
     def connect(self):
         print("server listening...",end="\t")
@@ -80,7 +134,7 @@ class TCPServer(Connection):
         self.socket.listen()
         self.client_socket, self.address = self.socket.accept()
     
-    def receive(self) -> str:
+    def receive(self) -> list[str]:
         return super().receive(self.client_socket)
     
     def send(self, message: str) -> None:
@@ -101,16 +155,8 @@ class SSHServer(Connection):
         self.ssh_remoteforward_port = self.get_ssh_port(inifile=inifile, name=name)
 
     def get_ssh_port(self, inifile:configparser.ConfigParser, name:str) -> int:
-        if name == inifile.get("agent","name1"):
-            return 0
-        elif name == inifile.get("agent","name2"):
-            return 1
-        elif name == inifile.get("agent","name3"):
-            return 2
-        elif name == inifile.get("agent","name4"):
-            return 3
-        elif name == inifile.get("agent","name5"):
-            return 4
+        number = agent_number(inifile=inifile, name=name)
+        return number - 1 if number is not None else None
     
     def read_ssh_config(self) -> paramiko.SSHConfigDict:
         config_file = os.path.expanduser(self.ssh_config_path)
@@ -153,7 +199,7 @@ class SSHServer(Connection):
         self.transport.request_port_forward(address="",port=remote_port)
         self.channel = self.transport.accept()
     
-    def receive(self) -> str:
+    def receive(self) -> list[str]:
         return super().receive(self.channel)
     
     def send(self, message: str) -> None:
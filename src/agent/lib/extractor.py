@@ -0,0 +1,130 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Optional
+
+from src.models.lib.names import name
+
+from .matcher import Matcher
+
+KINDS = ("vote", "seer")
+
+Talk = dict[str, str | int]
+# (新しい発話, これまでに分かっていることの要約) -> 抽出結果. 応答がなければNone
+Analyse = Callable[[list[Talk], str], Optional[dict | list]]
+
+
+@dataclass
+class Batch:
+    """Talks taken for one analysis.
+
+    talks are the ones the matcher could not resolve and that go to the model. local holds
+    (position, speaker, result) of the ones it did resolve.
+    """
+
+    kind: str
+    end: int
+    talks: list[Talk] = field(default_factory=list)
+    positions: list[int] = field(default_factory=list)
+    local: list[tuple[int, int, dict | list]] = field(default_factory=list)
+
+
+class Extractor:
+    """Vote declarations and seer claims of one day, kept up to date from the new talks only.
+
+    Each kind has a cursor into the talks of the day in the ChatHistory. The model is sent
+    the talks after the cursor together with a summary of what is already known, and its
+    answer is merged into the known state. The cursor moves only when the model answered,
+    so talks whose analysis failed or timed out are sent again next time.
+
+    With a matcher, talks it resolves by rule are merged without asking the model, and
+    only the rest are sent.
+
+    Args:
+        day (int): day whose talks are analysed
+        ignore (Iterable[str], optional): texts that never need analysing such as Skip and Over.
+            Defaults to ().
+        matcher (Optional[Matcher], optional): rule-based fast path. Defaults to None.
+    """
+
+    def __init__(self, day: int, ignore: Iterable[str] = (), matcher: Optional[Matcher] = None) -> None:
+        self.day = day
+        self.ignore = set(ignore)
+        self.matcher = matcher
+        self.votes: dict[int, int] = {}
+        self.claims: dict[tuple[int, int], dict[str, int | str]] = {}
+        self.cursors = {kind: 0 for kind in KINDS}
+        self.running: set[str] = set()
+        self.lock = threading.Lock()
+
+    def take(self, kind: str, history) -> Optional[Batch]:
+        """New talks the model has to analyse.
+
+        Returns None when no talk needs the model, after merging what the matcher resolved,
+        or when an analysis of the kind is still running. Every batch that is returned must be
+        passed to merge.
+        """
+        with self.lock:
+            if kind in self.running:
+                return None
+            talks = history.day(self.day)[self.cursors[kind]:]
+            batch = Batch(kind, self.cursors[kind] + len(talks))
+            for position, talk in enumerate(talks):
+                if talk["text"] in self.ignore:
+                    continue
+                found = self.matcher.resolve(kind, talk) if self.matcher else None
+                if found is None:
+                    batch.talks.append(talk)
+                    batch.positions.append(position)
+                else:
+                    batch.local.append((position, int(talk["agent"]), found))
+            if not batch.talks:
+                self.apply(batch, {} if kind == "vote" else [])
+                return None
+            self.running.add(kind)
+            return batch
+
+    def merge(self, batch: Batch, result: Optional[dict | list]) -> None:
+        """Add the model's answer for a batch from take. None leaves its talks to be sent again."""
+        with self.lock:
+            self.running.discard(batch.kind)
+            self.apply(batch, result)
+
+    def apply(self, batch: Batch, result: Optional[dict | list]) -> None:
+        # 後の発話ほど優先する. ルールで決まった結果は, 同じ話者がモデルに送った発話より前ならモデルの答えで上書きする
+        last = {int(talk["agent"]): position for position, talk in zip(batch.positions, batch.talks)}
+        parts = [found for position, actor, found in batch.local if position < last.get(actor, -1)]
+        if result is not None:
+            parts.append(result)
+        parts += [found for position, actor, found in batch.local if position >= last.get(actor, -1)]
+        for part in parts:
+            if batch.kind == "vote":
+                self.votes.update(part)
+            else:
+                for claim in part:
+                    self.claims[(claim["actor"], claim["target"])] = claim
+        if result is not None:
+            self.cursors[batch.kind] = batch.end
+
+    def known(self, kind: str) -> str:
+        """What is already known, in the output format of the analysis prompt."""
+        with self.lock:
+            if kind == "vote":
+                lines = [f"{name(actor)} -> {name(target)}" for actor, target in self.votes.items()]
+            else:
+                lines = [f"{name(claim['actor'])}, {name(claim['target'])}, {claim['report']}" for claim in self.claims.values()]
+        return "\n".join(lines)
+
+    def state(self, kind: str) -> dict[int, int] | list[dict[str, int | str]]:
+        with self.lock:
+            return dict(self.votes) if kind == "vote" else list(self.claims.values())
+
+    def analyse(self, kind: str, history, analyse: Analyse) -> dict[int, int] | list[dict[str, int | str]]:
+        """Analyse the new talks in this thread and return the whole known state of the kind."""
+        batch = self.take(kind, history)
+        if batch is not None:
+            result = None
+            try:
+                result = analyse(batch.talks, self.known(kind))
+            finally:
+                self.merge(batch, result)
+        return self.state(kind)
@@ -0,0 +1,121 @@
+import asyncio
+import configparser
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+REQUESTS = ("talk", "strike", "divine")
+
+
+@dataclass
+class HedgePolicy:
+    """Which models to ask and when to ask the next one.
+
+    models[0] is the primary. Each following model is launched once the previous attempt has
+    been running for the hedge delay, or immediately when it fails.
+    The delay is the `percentile` of the primary's observed latency once `min_samples`
+    latencies are known, otherwise `delay`. Every attempt is observed, including failed ones
+    and, as a lower bound, the ones cancelled before they finished.
+    """
+
+    models: list[str]
+    delay: float = 1.5
+    percentile: float | None = None
+    min_samples: int = 5
+
+
+def load_policies(inifile: configparser.ConfigParser) -> dict[str, HedgePolicy]:
+    """Read a HedgePolicy for each request type from the [hedge] section."""
+    defaults = {
+        "talk": "gpt-4, gpt-3.5-turbo",
+        "strike": "gpt-4, gpt-3.5-turbo",
+        "divine": "gpt-3.5-turbo",
+    }
+    policies = {}
+    for request in REQUESTS:
+        models = inifile.get("hedge", request, fallback=defaults[request])
+        percentile = inifile.getfloat("hedge", f"{request}_percentile", fallback=0.0)
+        policies[request] = HedgePolicy(
+            models=[model.strip() for model in models.split(",") if model.strip()],
+            delay=inifile.getfloat("hedge", f"{request}_delay", fallback=1.5),
+            percentile=percentile if percentile > 0 else None,
+        )
+    return policies
+
+
+class Hedger:
+    def __init__(self, policies: dict[str, HedgePolicy]) -> None:
+        self.policies = policies
+        self.latencies: dict[str, deque[float]] = {}
+
+    def record(self, model: str, latency: float) -> None:
+        self.latencies.setdefault(model, deque(maxlen=100)).append(latency)
+
+    def hedge_delay(self, policy: HedgePolicy) -> float:
+        latencies = self.latencies.get(policy.models[0])
+        if policy.percentile is None or latencies is None or len(latencies) < policy.min_samples:
+            return policy.delay
+        ordered = sorted(latencies)
+        rank = min(int(len(ordered) * policy.percentile / 100), len(ordered) - 1)
+        return ordered[rank]
+
+    async def run(
+        self,
+        request: str,
+        call: Callable[[str, Callable[[], bool]], str | int],
+        deadline: float,
+    ) -> str | int:
+        """Ask the models of the request's policy and return the first valid answer.
+
+        Args:
+            request (str): "talk", "strike" or "divine"
+            call (Callable[[str, Callable[[], bool]], str | int]): blocking call that takes the model name
+                and a function telling whether the attempt has been cancelled
+            deadline (float): event loop time after which "Timeout" is returned
+
+        Returns:
+            str | int: first answer that is not "Timeout", otherwise "Timeout"
+        """
+        policy = self.policies[request]
+        loop = asyncio.get_running_loop()
+        models = list(policy.models)
+        attempts: dict[asyncio.Future, tuple[str, threading.Event, float]] = {}
+
+        def launch() -> None:
+            model = models.pop(0)
+            cancelled = threading.Event()
+            task = asyncio.ensure_future(asyncio.to_thread(call, model, cancelled.is_set))
+            attempts[task] = (model, cancelled, loop.time())
+
+        launch()
+        next_launch = loop.time() + self.hedge_delay(policy)
+        result = "Timeout"
+        while attempts and result == "Timeout":
+            until = min(next_launch, deadline) if models else deadline
+            done, _ = await asyncio.wait(
+                attempts, timeout=max(until - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                model, _, start = attempts.pop(task)
+                # 勝ち負けや成否に関わらず記録する. 速い応答だけを学ぶと遅延が縮み続ける
+                self.record(model, loop.time() - start)
+                try:
+                    answer = task.result()
+                except Exception:
+                    continue
+                if answer != "Timeout" and answer != "":
+                    result = answer
+                    break
+            if loop.time() >= deadline:
+                break
+            # 失敗したら待たずに, 遅れていれば遅延後に次のモデルへ
+            if result == "Timeout" and models and (not attempts or loop.time() >= next_launch):
+                launch()
+                next_launch = loop.time() + self.hedge_delay(policy)
+        # 負けた試行は打ち切る. 所要時間は少なくともここまでの経過時間なので, それを記録する
+        for task, (model, cancelled, start) in attempts.items():
+            self.record(model, loop.time() - start)
+            cancelled.set()
+            task.cancel()
+        return result
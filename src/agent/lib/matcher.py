@@ -0,0 +1,94 @@
+import re
+from typing import Optional
+
+from .template import (COUNTER_SEER, DAY1_ENDING, DAY1_EVENING, DAY1_MORNING, DAY2_ENDING,
+                       DAY2_EVENING, DAY2_MORNING, GLHF, OVER, SEER_DECLARE, SKIP,
+                       VOTE_INQUIRE, WEREWOLF_DEAD, WEREWOLF_DECLARE)
+
+Talk = dict[str, str | int]
+
+AGENT = r"Agent\[0(\d)\](?:さん|様|君|くん)?"
+# 否定, 質問, 他人の発言の引用を含む発話はルールでは決めない
+UNSURE = re.compile(r"[?？]|しない|しません|せん|せず|するな|やめ|ではな|じゃな|と言|って言|らしい|かもしれ|迷")
+# 自分の投票の意思として言い切っているものだけ. 「投票しよう」「投票してほしい」「投票するべき」は他人への呼びかけ
+INTENT = r"(?:する(?:つもり|ことにし|と決め)?|します|しました)(?!べき|よう|な|人|の(?!だ))"
+VOTE = re.compile(rf"{AGENT}に投票{INTENT}|投票先は、?{AGENT}(?:に{INTENT}|に決め|です|だ)")
+SEER = re.compile(rf"占い(?:の)?結果、?{AGENT}(?:は|が)(人間|人狼|白|黒)")
+MENTION = re.compile(r"Agent\[0\d\]")
+REPORTS = {"人間": "白", "人狼": "黒", "白": "白", "黒": "黒"}
+
+
+class Matcher:
+    """Finds vote declarations and seer claims without the LLM.
+
+    Our own template utterances are recognised by one compiled alternation over every
+    persona's phrasing. Other utterances are skipped when they mention no agent, or resolved
+    by regular expressions when they mention a single agent and state its vote or result
+    plainly. Anything else is left to the LLM.
+    """
+
+    def __init__(self) -> None:
+        # (種類, テンプレート) 種類はvote/seer/counter/none
+        templates = [("seer", text) for text in SEER_DECLARE]
+        templates += [("counter", text) for text in COUNTER_SEER]
+        templates += [("vote", text) for text in WEREWOLF_DECLARE]
+        templates += [
+            ("none", text)
+            for texts in (
+                [OVER], SKIP, GLHF, DAY1_MORNING, DAY2_MORNING, DAY1_EVENING, DAY2_EVENING,
+                DAY1_ENDING, DAY2_ENDING, VOTE_INQUIRE, WEREWOLF_DEAD,
+            )
+            for text in texts
+        ]
+        self.kinds: dict[str, str] = {}
+        alternatives = []
+        for number, (kind, text) in enumerate(templates):
+            name = f"t{number}"
+            self.kinds[name] = kind
+            alternatives.append(f"(?P<{name}>{self.to_pattern(name, text)})")
+        self.templates = re.compile("|".join(alternatives))
+
+    @staticmethod
+    def to_pattern(name: str, text: str) -> str:
+        """Regular expression of a template. "Agent[0{}]" captures the agent, a bare "{}" the result."""
+        pattern = re.escape(text).replace(re.escape("Agent[0{}]"), rf"Agent\[0(?P<{name}_agent>\d)\]", 1)
+        return pattern.replace(re.escape("{}"), f"(?P<{name}_result>人間|人狼)", 1)
+
+    def template(self, talk: Talk) -> Optional[tuple[str, dict[str, str]]]:
+        match = self.templates.fullmatch(talk["text"].strip())
+        if match is None:
+            return None
+        name = match.lastgroup
+        groups = {key[len(name) + 1:]: value for key, value in match.groupdict().items() if value and key.startswith(f"{name}_")}
+        return self.kinds[name], groups
+
+    def resolve(self, kind: str, talk: Talk) -> Optional[dict[int, int] | list[dict[str, int | str]]]:
+        """The votes ("vote") or seer claims ("seer") the talk declares, or None when it needs the LLM."""
+        actor = int(talk["agent"])
+        text = talk["text"]
+        found = self.template(talk)
+        if found is not None:
+            template, groups = found
+            if kind == "vote":
+                return {actor: int(groups["agent"])} if template == "vote" else {}
+            if template == "seer":
+                return [{"actor": actor, "target": int(groups["agent"]), "report": REPORTS[groups["result"]]}]
+            if template == "counter":
+                return [{"actor": actor, "target": int(groups["agent"]), "report": "黒"}]
+            return []
+        mentions = set(MENTION.findall(text))
+        # 誰にも触れていなければ投票先も占いの対象もない
+        if not mentions:
+            return {} if kind == "vote" else []
+        # 複数のエージェントに触れていれば, 複数の宣言や他人の宣言の話かもしれない.
+        # キーワードの無い言い回し(一票入れる等)もあるので, 分からなければLLMに任せる
+        if len(mentions) > 1 or UNSURE.search(text):
+            return None
+        if kind == "vote":
+            targets = {int(a or b) for a, b in VOTE.findall(text)}
+            return {actor: targets.pop()} if len(targets) == 1 else None
+        claims = SEER.findall(text)
+        if len(claims) == 1:
+            target, report = claims[0]
+            return [{"actor": actor, "target": int(target), "report": REPORTS[report]}]
+        return None
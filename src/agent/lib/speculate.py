@@ -0,0 +1,80 @@
+import asyncio
+import contextvars
+import threading
+from typing import Callable, Iterable, Optional
+
+from src.models.lib.names import mention
+
+from .matcher import Matcher
+
+Talk = dict[str, str | int]
+
+
+class Speculation:
+    """The next talk, generated while the server is still collecting the other agents' talks.
+
+    start() is called right after a talk is answered with what the next turn is expected to
+    ask, and with the answered talk already in its history. Talks that arrive in the meantime
+    are passed to observe(). Any that mentions this agent, or that the matcher cannot rule out
+    as a vote declaration or a seer claim, makes the speculation stale, because the next
+    prompt would differ in substance. take() returns the generation only when it is still
+    fresh and the key of the turn matches.
+
+    Args:
+        index (int): this agent's number
+        matcher (Matcher): decides which talks change the vote declarations or seer claims
+    """
+
+    def __init__(self, index: int, matcher: Matcher) -> None:
+        self.index = index
+        self.mention = mention(index)
+        self.matcher = matcher
+        self.key: Optional[tuple] = None
+        self.future: Optional[asyncio.Future] = None
+        self.cancelled = threading.Event()
+        self.stale = False
+
+    def start(self, key: tuple, call: Callable[[Callable[[], bool]], str | int]) -> None:
+        """Run the blocking call in the event loop's executor. It takes a cancellation check."""
+        self.discard()
+        cancelled = threading.Event()
+        self.key = key
+        self.cancelled = cancelled
+        self.stale = False
+        # スレッドはイベントループが止まっている間も生成を続ける.
+        # run_in_executorはcontextvarsを引き継がないので, spanや記録のゲーム・日・エージェントを写しておく
+        context = contextvars.copy_context()
+        self.future = asyncio.get_running_loop().run_in_executor(None, context.run, call, cancelled.is_set)
+
+    def observe(self, talks: Iterable[Talk]) -> None:
+        if self.future is None or self.stale:
+            return
+        for talk in talks:
+            if self.material(talk):
+                self.discard()
+                self.stale = True
+                return
+
+    def material(self, talk: Talk) -> bool:
+        """Whether the talk would change what is generated next. Our own talks were known at start."""
+        if int(talk["agent"]) == self.index:
+            return False
+        if self.mention in talk["text"]:
+            return True
+        return any(self.matcher.resolve(kind, talk) != ({} if kind == "vote" else []) for kind in ("vote", "seer"))
+
+    def take(self, key: tuple) -> Optional[asyncio.Future]:
+        """The pending or finished generation for the turn, or None when there is no usable one."""
+        future = self.future if self.key == key and not self.stale else None
+        if future is None:
+            self.discard()
+        else:
+            self.future = None
+        return future
+
+    def discard(self) -> None:
+        if self.future is not None:
+            self.cancelled.set()
+            self.future.cancel()
+            self.future = None
+        self.key = None
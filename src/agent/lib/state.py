@@ -0,0 +1,85 @@
+from functools import lru_cache
+from typing import Optional
+
+from src.models.lib.names import MAX_AGENTS, NAMES
+
+
+@lru_cache(maxsize=None)
+def members(mask: int) -> tuple[int, ...]:
+    """Agent numbers whose bit is set, in ascending order."""
+    return tuple(idx for idx in range(mask.bit_length()) if mask >> idx & 1)
+
+
+@lru_cache(maxsize=None)
+def names(mask: int) -> str:
+    """Display names of the agents in the mask joined as in the prompts, e.g. "Agent[01], Agent[03]"."""
+    return ", ".join(NAMES[idx] for idx in members(mask))
+
+
+class GameState:
+    """What the agent knows of the game, updated from each gameInfo.
+
+    Agents are plain ints. Who is alive is a bitmask (bit n is Agent[0n]), so checking an
+    agent is O(1) and the lists derived from it are cached per mask across games. Roles are
+    an array indexed by agent number holding only the ones revealed to us.
+
+    Args:
+        size (int, optional): number of agents. Defaults to 5.
+    """
+
+    __slots__ = ("size", "me", "day", "alive_mask", "roles", "divine_result", "executed", "attacked")
+
+    def __init__(self, size: int = 5) -> None:
+        self.size = size
+        self.me = 0
+        self.day = 0
+        self.alive_mask = 0
+        self.roles: list[Optional[str]] = [None] * (size + 1)
+        self.divine_result: Optional[tuple[int, str]] = None  # (対象, "HUMAN" or "WEREWOLF")
+        self.executed: Optional[int] = None
+        self.attacked: Optional[int] = None
+
+    def update(self, game_info: dict) -> None:
+        self.me = game_info["agent"]
+        self.day = game_info["day"]
+        mask = 0
+        for agent, status in game_info["statusMap"].items():
+            if status == "ALIVE":
+                mask |= 1 << int(agent)
+        self.alive_mask = mask
+        for agent, role in game_info["roleMap"].items():
+            self.roles[int(agent)] = role
+        divined = game_info.get("divineResult")
+        self.divine_result = (divined["target"], divined["result"]) if divined else None
+        self.executed = game_info.get("executedAgent")
+        self.attacked = game_info.get("attackedAgent")
+
+    @property
+    def role(self) -> Optional[str]:
+        return self.roles[self.me]
+
+    def is_alive(self, agent: int) -> bool:
+        return bool(self.alive_mask >> agent & 1)
+
+    def alive(self) -> tuple[int, ...]:
+        return members(self.alive_mask)
+
+    def dead(self) -> tuple[int, ...]:
+        return members(self.all_mask() & ~self.alive_mask)
+
+    def targets(self) -> tuple[int, ...]:
+        """Alive agents other than us."""
+        return members(self.alive_mask & ~(1 << self.me))
+
+    def all_mask(self) -> int:
+        return ((1 << (self.size + 1)) - 1) & ~1
+
+    def alive_names(self) -> str:
+        return names(self.alive_mask)
+
+    def dead_names(self) -> str:
+        return names(self.all_mask() & ~self.alive_mask)
+
+    def target_names(self, exclude: int = 0) -> str:
+        """Names of the alive agents other than us and exclude."""
+        return names(self.alive_mask & ~(1 << self.me) & ~(1 << exclude))
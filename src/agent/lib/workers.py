@@ -0,0 +1,244 @@
+import atexit
+import contextvars
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from src.models.lib import tracing
+
+
+@dataclass
+class VoteAnalysis:
+    talks: list[dict[str, str | int]]
+    index: int
+    known: str = ""
+
+
+@dataclass
+class SeerAnalysis:
+    talks: list[dict[str, str | int]]
+    index: int
+    known: str = ""
+
+
+@dataclass
+class BackupTalk:
+    system_call: dict[str, str]
+    history: Any  # ChatHistory
+    towards_me: list[dict[str, str]] = field(default_factory=list)
+    model: str = "gpt-3.5-turbo"
+
+
+Task = VoteAnalysis | SeerAnalysis | BackupTalk
+
+# 同時に実行中のタスクの数より十分大きければよい. 番号 % SLOTSの枠に取り消したタスクの番号を書く
+SLOTS = 256
+# 取り消しを確かめる間隔(秒)
+POLL_INTERVAL = 0.02
+
+# ワーカープロセス側の状態. initializeで1度だけ作る
+_model = None
+_generation = None
+_cancelled = None
+_barrier = None
+
+
+def _initialize(factory: Callable[[], Any], generation, cancelled, barrier) -> None:
+    global _model, _generation, _cancelled, _barrier
+    _model = factory()
+    _generation = generation
+    _cancelled = cancelled
+    _barrier = barrier
+
+
+def _warm(timeout: float) -> int:
+    """Wait until every worker has built its model. Each worker holds one of these until then."""
+    _barrier.wait(timeout)
+    return os.getpid()
+
+
+def _run(task: Task, generation: int, number: int, context: dict[str, Any]) -> Any:
+    """Run a task in a worker with the caller's tracing context, so that its records and spans
+    name the game, day and agent. The context is set in a copy and does not leak into the next task.
+    """
+    return contextvars.copy_context().run(_execute, task, generation, number, context)
+
+
+def _execute(task: Task, generation: int, number: int, context: dict[str, Any]) -> Any:
+    """Cancelled tasks and tasks of a finished day return None."""
+    tracing.set_context(**context)
+
+    def is_cancelled() -> bool:
+        return _generation.value != generation or _cancelled[number % SLOTS] == number
+
+    if is_cancelled():
+        return None
+    if isinstance(task, VoteAnalysis):
+        return _model.vote_declare(task.talks, task.index, known=task.known)
+    if isinstance(task, SeerAnalysis):
+        return _model.seer_declare(task.talks, task.index, known=task.known)
+    return _model.multi_turn_chat_completion(
+        task.system_call,
+        task.history,
+        task.towards_me,
+        model=task.model,
+        is_cancelled=is_cancelled,
+    )
+
+
+class WorkerPool:
+    """Long-lived worker processes that keep a model, and with it warm HTTP clients and caches.
+
+    One pool serves every agent and game of the process (see shared()). ProcessPoolExecutor
+    starts its processes on the first submit, so warm() starts them and builds the models
+    before the first TALK. Agents use the pool through a Session.
+
+    Tasks submitted before cancel() belong to an older generation. The ones still queued are
+    cancelled. A running BackupTalk stops streaming, while a running analysis runs to its end.
+    call() returns the default instead of the result of any of them. A single task is
+    cancelled the same way when its caller gives up on it.
+
+    Args:
+        factory (Callable[[], Any]): builds the model once in each worker
+        size (int, optional): number of worker processes. Defaults to 5.
+    """
+
+    def __init__(self, factory: Callable[[], Any], size: int = 5) -> None:
+        self.size = size
+        self.generation = multiprocessing.Value("i", 0)
+        self.cancelled = multiprocessing.Array("q", [-1] * SLOTS)
+        self.numbers = itertools.count()
+        self.executor = ProcessPoolExecutor(
+            max_workers=size,
+            initializer=_initialize,
+            initargs=(factory, self.generation, self.cancelled, multiprocessing.Barrier(size)),
+        )
+        self.pending: set[Future] = set()
+        self.lock = threading.Lock()
+        self.warm_lock = threading.Lock()
+        self.warmed = False
+
+    def warm(self, timeout: float = 60.0) -> None:
+        """Start every worker and wait until each has built its model. Returns at once when done before."""
+        with self.warm_lock:
+            if self.warmed:
+                return
+            futures = [self.executor.submit(_warm, timeout) for _ in range(self.size)]
+            for future in futures:
+                try:
+                    future.result(timeout)
+                except Exception:
+                    pass
+            self.warmed = True
+
+    def submit(self, task: Task) -> tuple[Future, int]:
+        with self.lock:
+            number = next(self.numbers)
+        future = self.executor.submit(_run, task, self.generation.value, number, tracing.context())
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future, number
+
+    def call(
+        self,
+        task: Task,
+        timeout: Optional[float] = None,
+        default: Any = None,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+        submit: Optional[Callable[[Task], tuple[Future, int]]] = None,
+    ) -> Any:
+        """Result of the task, or default when it fails, is cancelled or takes longer than timeout.
+
+        Blocks the calling thread. When is_cancelled becomes true or the timeout passes, the
+        task is cancelled in the worker so that it frees the process for the next one.
+        """
+        generation = self.generation.value
+        future, number = (submit or self.submit)(task)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if is_cancelled is not None:
+                    if is_cancelled():
+                        break
+                    wait = POLL_INTERVAL if wait is None else min(wait, POLL_INTERVAL)
+                if wait is not None and wait <= 0:
+                    break
+                try:
+                    result = future.result(wait)
+                except FutureTimeoutError:
+                    continue
+                # 待っている間に取り消されたタスクの結果は, 最後まで走っていても使わない
+                if self.generation.value != generation or self.cancelled[number % SLOTS] == number:
+                    return default
+                return result
+        except Exception:
+            return default
+        self.cancel_task(future, number)
+        return default
+
+    def cancel_task(self, future: Future, number: int) -> None:
+        self.cancelled[number % SLOTS] = number
+        future.cancel()
+
+    def cancel(self) -> None:
+        """Drop every unfinished task."""
+        with self.generation.get_lock():
+            self.generation.value += 1
+        for future in list(self.pending):
+            future.cancel()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def session(self) -> "Session":
+        return Session(self)
+
+
+class Session:
+    """Tasks of one agent on a shared WorkerPool. cancel() drops only this agent's tasks."""
+
+    def __init__(self, pool: WorkerPool) -> None:
+        self.pool = pool
+        self.pending: dict[Future, int] = {}
+
+    def submit(self, task: Task) -> tuple[Future, int]:
+        future, number = self.pool.submit(task)
+        self.pending[future] = number
+        future.add_done_callback(lambda done: self.pending.pop(done, None))
+        return future, number
+
+    def call(
+        self,
+        task: Task,
+        timeout: Optional[float] = None,
+        default: Any = None,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+    ) -> Any:
+        return self.pool.call(task, timeout, default, is_cancelled, submit=self.submit)
+
+    def cancel(self) -> None:
+        """Drop every unfinished task of this agent."""
+        for future, number in list(self.pending.items()):
+            self.pool.cancel_task(future, number)
+
+
+_shared: Optional[WorkerPool] = None
+_shared_lock = threading.Lock()
+
+
+def shared(factory: Callable[[], Any], size: int = 5) -> WorkerPool:
+    """The pool of this process. Created on the first call and shut down at exit."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = WorkerPool(factory, size)
+            atexit.register(_shared.shutdown)
+        return _shared
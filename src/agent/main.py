@@ -1,25 +1,89 @@
+import asyncio
+import configparser
 import json
 import random
-from multiprocessing import Process, Queue
+import uuid
+from functools import partial
 
 from lib import util
 from lib.commands import AIWolfCommand
+from lib.extractor import Extractor
+from lib.hedge import Hedger, load_policies
+from lib.matcher import Matcher
+from lib.speculate import Speculation
+from lib.state import NAMES, GameState
+from lib import workers
+from lib.workers import BackupTalk, SeerAnalysis, VoteAnalysis
 
 from src.agent.lib.template import *
 from src.models.gpt.main import GptClass
 from src.models.gemini.main import GeminiClass
+from src.models.lib.cache import DEFAULT_REQUESTS, ResponseCache
+from src.models.lib.fewshot import FewShot
+from src.models.lib import records, tracing
+from src.models.lib.history import ChatHistory
+from src.models.lib.names import mention
+
+
+def build_model(inifile: configparser.ConfigParser, model: str = "gpt") -> GptClass | GeminiClass:
+    """config.iniの[model]/[cache]/[budget]/[fewshot]/[records]からモデルを作る. ワーカープロセスでも同じものを作る"""
+    # モデル呼び出しの記録. ワーカープロセスではそのプロセスのファイルに書く
+    if inifile.getboolean("records", "enable", fallback=False):
+        records.configure(
+            path=inifile.get("records", "path", fallback="logs/records.jsonl"),
+            max_bytes=inifile.getint("records", "max_bytes", fallback=10 * 1024 * 1024),
+            backups=inifile.getint("records", "backups", fallback=10),
+            compress=inifile.getboolean("records", "compress", fallback=True),
+            console=inifile.getboolean("records", "console", fallback=False),
+        )
+    # プロセス内で共有する接続プールの設定
+    pool_size = inifile.getint("model", "pool_size", fallback=10)
+    http2 = inifile.getboolean("model", "http2", fallback=False)
+    stream = inifile.getboolean("model", "stream", fallback=False)
+    # 同じ入力に対する応答のキャッシュ
+    cache = None
+    if inifile.getboolean("cache", "enable", fallback=False):
+        cache = ResponseCache(
+            memory_size=inifile.getint("cache", "memory_size", fallback=1024),
+            path=inifile.get("cache", "path", fallback="") or None,
+            ttl=inifile.getfloat("cache", "ttl", fallback=7 * 24 * 3600),
+            disk_size=inifile.getint("cache", "disk_size", fallback=100000),
+            requests=[
+                request.strip()
+                for request in inifile.get("cache", "requests", fallback=", ".join(DEFAULT_REQUESTS)).split(",")
+            ],
+        )
+    # 空でなければAPIの代わりにモックサーバなどへ送る
+    base_url = inifile.get("model", "base_url", fallback="") or None
+    # リクエスト種別ごとのプロンプトのトークン数の上限
+    budgets = {request: inifile.getint("budget", request) for request in inifile.options("budget")} if inifile.has_section("budget") else {}
+    # 投票先/占い結果の解析の例を選ぶ索引. 起動時にmmapで開いておく
+    fewshot = None
+    if inifile.get("fewshot", "index", fallback=""):
+        fewshot = FewShot(inifile.get("fewshot", "index"), inifile.getint("fewshot", "k", fallback=4))
+        fewshot.prepare()
+    if model == "gpt":
+        return GptClass(
+            pool_size=pool_size, http2=http2, stream=stream, cache=cache, base_url=base_url, budgets=budgets, fewshot=fewshot
+        )
+    else:
+        return GeminiClass(pool_size=pool_size, http2=http2, stream=stream, cache=cache, base_url=base_url, budgets=budgets)
+
+
+def shared_workers(inifile: configparser.ConfigParser) -> workers.WorkerPool:
+    """プロセスで1つのワーカープール. ゲームやエージェントごとには作り直さない"""
+    return workers.shared(partial(build_model, inifile), inifile.getint("agent", "workers", fallback=5))
 
 
 class Agent:
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, inifile: configparser.ConfigParser) -> None:
         self.name = name
         self.received = []
         self.gameContinue = True
-        model = "gpt"
-        if model == "gpt":
-            self.model = GptClass()
-        else:
-            self.model = GeminiClass()
+        self.inifile = inifile
+        self.model = build_model(inifile)
+        self.workers = None
+        self.state = GameState()
         self.system_call = {
             "request": str,
             "idx": str,
@@ -27,32 +91,45 @@ class Agent:
             "target": str,
             "behavior": str,
         }
+        # TALK中の分析と保険の発話生成をスレッドで行うか(async), 常駐のワーカープロセスで行うか(process)
+        self.execution = inifile.get("agent", "execution", fallback="async")
+        self.talk_timeout = inifile.getfloat("agent", "talk_timeout", fallback=4.5)
+        # 同期で呼ばれるestablish.pyのためのループ. host.pyでは使わないので必要になってから作る
+        self.loop = None
+        # talk/strike/divineごとに, 主モデルが遅れた時に保険のモデルへ投げ直す方針
+        self.hedger = Hedger(load_policies(inifile))
+        # テンプレート通りの発話や単純な宣言はLLMに送らずに解析する
+        self.matcher = Matcher()
+        # 応答を返した後, 次のTALKの発話をサーバを待つ間に生成しておくか
+        self.speculate = inifile.getboolean("agent", "speculate", fallback=False)
+        self.speculation = None
+        # 既定では無効. 有効にすると各段階の所要時間をspanとして書き出す
+        tracing.configure(
+            exporter=inifile.get("tracing", "exporter", fallback=""),
+            path=inifile.get("tracing", "path", fallback="logs/spans.jsonl"),
+            endpoint=inifile.get("tracing", "endpoint", fallback=None),
+        )
+        tracing.set_context(game=uuid.uuid4().hex[:8], name=name)
 
     def set_received(self, received: list) -> None:
         self.received = received
 
-    def parse_info(self, receive: str) -> None:
-        received_list = receive.split("}\n{")
-
-        for index in range(len(received_list)):
-            received_list[index] = received_list[index].rstrip()
-
-            if received_list[index][0] != "{":
-                received_list[index] = "{" + received_list[index]
-
-            if received_list[index][-1] != "}":
-                received_list[index] += "}"
-
-            self.received.append(received_list[index])
+    def parse_info(self, receive: list[str]) -> None:
+        self.received.extend(receive)
 
     def get_info(self):
         data = json.loads(self.received.pop(0))
         self.request = data["request"]
-        # ゲームの情報が変更されていれば適応
-        if data["gameInfo"]:
-            self.gameInfo = data["gameInfo"]
+        tracing.set_context(
+            request=self.request,
+            day=data["gameInfo"]["day"] if data["gameInfo"] else None,
+            agent=data["gameInfo"]["agent"] if data["gameInfo"] else None,
+        )
+        # ゲームの情報が変更されていれば適応. 生のJSONは持たずに必要な分だけ取り込む
         if data["gameSetting"]:
-            self.gameSetting = data["gameSetting"]
+            self.state = GameState(data["gameSetting"]["playerNum"])
+        if data["gameInfo"]:
+            self.state.update(data["gameInfo"])
         # 発話履歴に更新があったか
         self.talkHistory = data["talkHistory"]
         if self.talkHistory:
@@ -62,12 +139,21 @@ class Agent:
                 elif talk["text"] == "Over":
                     talk["text"] = OVER
                 self.all_history.append(talk)
+            if self.speculation is not None:
+                self.speculation.observe(self.talkHistory)
 
     def initialize(self) -> None:
-        self.index = self.gameInfo["agent"]
-        self.role = self.gameInfo["roleMap"][str(self.index)]
+        self.index = self.state.me
+        self.role = self.state.role
         self.day_count = -1
-        self.all_history = []
+        self.all_history = ChatHistory()
+        if self.speculate:
+            self.speculation = Speculation(self.index, self.matcher)
+        if self.execution == "process" and self.workers is None:
+            pool = shared_workers(self.inifile)
+            # 最初のTALKの締め切り内でプロセスの起動とモデルの構築をしないよう, ここで済ませておく. 2回目以降はすぐ返る
+            pool.warm()
+            self.workers = pool.session()
 
     def daily_initialize(self) -> None:
         self.day_count += 1
@@ -75,29 +161,17 @@ class Agent:
         self.reply = 0
         self.vote_dict = {}
         self.seer_dict = {}
+        # その日の発話から投票先と占い結果を差分で抽出する
+        self.extractor = Extractor(self.day_count, ignore={SKIP[0], OVER}, matcher=self.matcher)
         self.is_close = False
-        self.alive = [
-            int(agent)
-            for agent in self.gameInfo["statusMap"]
-            if self.gameInfo["statusMap"][agent] == "ALIVE"
-        ]
-
-        # 生存者と死亡者
-        alive_list: list = []
-        dead_list: list = []
-        for agent_num in self.gameInfo["statusMap"]:
-            if self.gameInfo["statusMap"][agent_num] == "ALIVE":
-                alive_list.append(f"Agent[0{agent_num}]")
-            else:
-                dead_list.append(f"Agent[0{agent_num}]")
 
         # 各役職の振る舞い
         self.divine_result = ""
         if self.role == "SEER":
-            if self.gameInfo["divineResult"]:
-                divined = self.gameInfo["divineResult"]
-                result = "人間" if divined["result"] == "HUMAN" else "人狼"
-                self.divine_result = SEER_DECLARE[self.index].format(divined["target"], result)
+            if self.state.divine_result:
+                divined, species = self.state.divine_result
+                result = "人間" if species == "HUMAN" else "人狼"
+                self.divine_result = SEER_DECLARE[self.index].format(divined, result)
             behavior = "SEER"
         elif self.role == "POSSESSED":
             if self.day_count == 2:
@@ -109,18 +183,19 @@ class Agent:
 
         # talkで使うsystem_call
         self.system_call = {
-            "idx": f"Agent[0{self.index}]",
-            "alive": ", ".join(alive_list),
-            "dead": ", ".join(dead_list),
+            "idx": NAMES[self.index],
+            "alive": self.state.alive_names(),
+            "dead": self.state.dead_names(),
             "behavior": behavior,
         }
 
     def daily_finish(self) -> None:
-        self.all_history = [
-            talk
-            for talk in self.all_history
-            if talk["text"] != SKIP[0] and talk["text"] != OVER
-        ]
+        self.all_history.discard({SKIP[0], OVER}, self.day_count)
+        if self.speculation is not None:
+            self.speculation.discard()
+        # その日の分析や生成が残っていても結果は使わない
+        if self.workers is not None:
+            self.workers.cancel()
 
     def get_name(self) -> str:
         return self.name
@@ -129,12 +204,15 @@ class Agent:
         return self.role
 
     def talk(self) -> str:
+        return self.run(self.talk_coroutine())
+
+    async def talk_coroutine(self) -> str:
         self.talk_count += 1
         # 1巡分の発話分析
         towards_me = []
         for chat in self.talkHistory:
-            if f">>Agent[0{self.index}]" in chat["text"]:
-                towards_me.append({"from": chat["agent"], "text": chat["text"][12:]})
+            if mention(self.index) in chat["text"]:
+                towards_me.append({"from": chat["agent"], "text": chat["text"][len(mention(self.index)) + 1 :]})
             elif OVER in chat["text"]:
                 if not self.vote_dict.get(chat["agent"]):
                     self.vote_dict[chat["agent"]] = 0
@@ -150,43 +228,12 @@ class Agent:
                 comment = "Over"
         else:
             is_seer_analyze = self.day_count == 1 and ((self.talk_count < 4 and self.role == "WEREWOLF") or (self.talk_count < 3 and self.role == "POSSESSED"))
-            if is_seer_analyze:
-                q3 = Queue()
-                before = [history for history in self.all_history if history["day"] == 1]
-                p3 = Process(target=self.model.seer_declare, args=(before, self.index, q3))
-                p3.start()
-            q1 = Queue()
-            p1 = Process(target=self.model.vote_declare, args=(self.talkHistory, self.index, q1))
-            p1.start()
-            if self.divine_result and self.talk_count == 1:
-                comment = self.divine_result
-            elif self.role == "POSSESSED" and self.talk_count == 1 and self.day_count == 2:
-                comment = WEREWOLF_DECLARE[self.index].format(self.index)
-            elif not self.talkHistory:
-                comment = DAY1_MORNING[self.index] if self.day_count == 1 else DAY2_MORNING[self.index]
-            else:
-                self.system_call["request"] = "talk"
-                is_strike = (self.day_count == 1 and self.talk_count == 3) or (self.day_count == 2 and self.talk_count == 2)
-                if is_strike:
-                    self.system_call["request"] = "strike"
-                q2 = Queue()
-                p2 = Process(target=self.model.pipe_model2agent,
-                             args=(self.system_call, self.all_history, towards_me, q2))
-                p2.start()
-                comment = self.model.multi_turn_chat_completion(
-                    self.system_call, self.all_history, towards_me, "gpt-4"
-                )
-                p2.join()
-            # 保険
-            if comment == "Timeout":
-                comment = q2.get()
+            comment, seer_info, vote_dict = await self.talk_async(towards_me, is_seer_analyze)
             # 保険の保険
             if comment == "Timeout":
                 comment = SKIP[self.index]
             # 占いCOの分析
             if is_seer_analyze:
-                p3.join()
-                seer_info: list = q3.get()
                 if self.role == "WEREWOLF":
                     alert = False
                     for info in seer_info:
@@ -234,12 +281,10 @@ class Agent:
                                 comment = COUNTER_SEER[self.index].format(target)
                                 self.system_call["behavior"] = "SEER"
             # 投票先の分析
-            p1.join()
-            vote_dict: dict = q1.get()
             if vote_dict:
                 self.vote_dict.update(vote_dict)
             # 投票先を宣言していない人々
-            vote_undeclare: list = [agent for agent in self.alive if self.vote_dict.get(agent) is None]
+            vote_undeclare: list = [agent for agent in self.state.alive() if self.vote_dict.get(agent) is None]
             # 自分に投票すると宣言している人々
             snipers: list = [k for k, v in self.vote_dict.items() if v == self.index]
             # リプライ判定
@@ -253,7 +298,7 @@ class Agent:
                     self.is_close = True
                     if self.day_count == 2 and self.role == "POSSESSED":
                         comment = WEREWOLF_DEAD[self.index]
-                    elif len(snipers) > (len(self.alive) // 2):
+                    elif len(snipers) > (len(self.state.alive()) // 2):
                         comment = DAY1_ENDING[self.index] if self.day_count == 1 else DAY2_ENDING[self.index]
                     else:
                         comment = DAY1_EVENING[self.index] if self.day_count == 1 else DAY2_EVENING[self.index]
@@ -266,47 +311,151 @@ class Agent:
                         idx = int(random.choice(vote_undeclare))
                         comment = VOTE_INQUIRE[self.index].format(idx)
                         self.vote_dict[idx] = 6
-        print(f"Agent[0{self.index}]: {comment}")
+            if self.speculation is not None and not self.is_close:
+                self.start_speculation(str(comment))
+        records.record("talk", text=str(comment))
         return str(comment)
 
+    def fixed_comment(self) -> str | None:
+        """LLMを使わずに決まる発話. なければNone"""
+        if self.divine_result and self.talk_count == 1:
+            return self.divine_result
+        elif self.role == "POSSESSED" and self.talk_count == 1 and self.day_count == 2:
+            return WEREWOLF_DECLARE[self.index].format(self.index)
+        elif not self.talkHistory:
+            return DAY1_MORNING[self.index] if self.day_count == 1 else DAY2_MORNING[self.index]
+        return None
+
+    def set_talk_request(self) -> None:
+        self.system_call["request"] = self.talk_request(self.talk_count)
+
+    def talk_request(self, talk_count: int) -> str:
+        is_strike = (self.day_count == 1 and talk_count == 3) or (self.day_count == 2 and talk_count == 2)
+        return "strike" if is_strike else "talk"
+
+    def speculation_key(self, talk_count: int, system_call: dict) -> tuple:
+        return (self.day_count, talk_count, tuple(sorted(system_call.items())))
+
+    def start_speculation(self, comment: str) -> None:
+        """返した発話を履歴に加えた状態で, 次のターンの発話を主モデルで生成しておく"""
+        system_call = dict(self.system_call, request=self.talk_request(self.talk_count + 1))
+        all_history = self.all_history.copy()
+        all_history.append({"day": self.day_count, "agent": self.index, "text": comment})
+        model = self.hedger.policies[system_call["request"]].models[0]
+        self.speculation.start(
+            self.speculation_key(self.talk_count + 1, system_call),
+            lambda is_cancelled: self.complete(system_call, all_history, [], model, is_cancelled),
+        )
+
+    async def generate_talk(self, towards_me: list, deadline: float) -> str | int:
+        """先読みした発話が使えればそれを返し, 使えなければ生成し直す"""
+        if self.speculation is not None:
+            future = self.speculation.take(self.speculation_key(self.talk_count, self.system_call))
+            if future is not None:
+                with tracing.span("speculation"):
+                    comment = await self.wait_until(future, deadline, "Timeout")
+                if comment != "Timeout" and comment != "":
+                    return comment
+        return await self.generate(towards_me, deadline)
+
+    async def talk_async(self, towards_me: list, is_seer_analyze: bool) -> tuple[str, list, dict]:
+        """分析と保険の発話生成をコルーチンとして並行させ, 共通の締め切りまで待つ"""
+        deadline = asyncio.get_running_loop().time() + self.talk_timeout
+        seer_task = None
+        # 前回の分析より後の発話だけを送る. 締め切りに間に合わなかった結果も次回までに統合される
+        if is_seer_analyze:
+            seer_task = asyncio.create_task(
+                asyncio.to_thread(
+                    self.extractor.analyse,
+                    "seer",
+                    self.all_history,
+                    self.seer_analysis,
+                )
+            )
+        vote_task = asyncio.create_task(
+            asyncio.to_thread(
+                self.extractor.analyse,
+                "vote",
+                self.all_history,
+                self.vote_analysis,
+            )
+        )
+        comment = self.fixed_comment()
+        if comment is None:
+            self.set_talk_request()
+            comment = await self.generate_talk(towards_me, deadline)
+        seer_info = []
+        if seer_task:
+            with tracing.span("wait.seer_declare"):
+                seer_info = await self.wait_until(seer_task, deadline, self.extractor.state("seer"))
+        with tracing.span("wait.vote_declare"):
+            vote_dict = await self.wait_until(vote_task, deadline, self.extractor.state("vote"))
+        return comment, seer_info, vote_dict
+
+    async def generate(self, towards_me: list, deadline: float) -> str | int:
+        """system_call["request"]のヘッジ方針に従ってLLMで生成する. 締め切りまでに得られなければTimeout"""
+        # スレッドから参照されるので, 呼び出し時点の値を渡す
+        system_call = dict(self.system_call)
+        all_history = self.all_history.copy()
+        with tracing.span("hedge", hedge_request=system_call["request"]):
+            return await self.hedger.run(
+                system_call["request"],
+                lambda model, is_cancelled: self.complete(system_call, all_history, towards_me, model, is_cancelled),
+                deadline,
+            )
+
+    # 以下はスレッドから呼ばれる. process実行ではワーカープロセスに投げて結果を待つ
+    def vote_analysis(self, talks: list, known: str) -> dict | None:
+        if self.workers is not None:
+            return self.workers.call(VoteAnalysis(talks, self.index, known), self.talk_timeout)
+        return self.model.vote_declare(talks, self.index, known=known)
+
+    def seer_analysis(self, talks: list, known: str) -> list | None:
+        if self.workers is not None:
+            return self.workers.call(SeerAnalysis(talks, self.index, known), self.talk_timeout)
+        return self.model.seer_declare(talks, self.index, known=known)
+
+    def complete(self, system_call: dict, all_history: ChatHistory, towards_me: list, model: str, is_cancelled) -> str | int:
+        if self.workers is not None:
+            return self.workers.call(
+                BackupTalk(system_call, all_history, towards_me, model), self.talk_timeout, "Timeout", is_cancelled
+            )
+        return self.model.multi_turn_chat_completion(
+            system_call, all_history, towards_me, model=model, is_cancelled=is_cancelled
+        )
+
+    async def wait_until(self, aw, deadline: float, default):
+        """締め切りまでに終わらなければdefaultを返す"""
+        try:
+            return await asyncio.wait_for(aw, max(deadline - asyncio.get_running_loop().time(), 0))
+        except Exception:
+            return default
+
     def vote(self) -> str:
-        target: list = [
-            int(agent)
-            for agent in self.gameInfo["statusMap"]
-            if self.gameInfo["statusMap"][agent] == "ALIVE"
-        ]
-        target.remove(self.index)
+        target = self.state.targets()
         if self.vote_dict.get(self.index) in target:
             one = self.vote_dict.get(self.index)
         else:
             one = util.random_select(target)
-        print(f"vote: {self.index} > {one}")
+        records.record("vote", target=one)
         data = {"agentIdx": one}
 
         return json.dumps(data, separators=(",", ":"))
 
     def divine(self) -> str:
-        target = [
-            int(agent)
-            for agent in self.gameInfo["statusMap"]
-            if self.gameInfo["statusMap"][agent] == "ALIVE"
-        ]
-        target.remove(self.index)
+        return self.run(self.divine_coroutine())
+
+    async def divine_coroutine(self) -> str:
+        target = self.state.targets()
         if self.day_count == 0:
             self.divined = util.random_select(target)
             data = {"agentIdx": self.divined}
         elif self.day_count == 1:
-            if self.divined in target:
-                target.remove(self.divined)
-            target_list: list[str] = []
-            for agent in target:
-                target_list.append(f"Agent[0{agent}]")
-            self.system_call["target"] = ", ".join(target_list)
+            target = tuple(agent for agent in target if agent != self.divined)
+            self.system_call["target"] = self.state.target_names(exclude=self.divined)
             self.system_call["request"] = "divine"
-            result = self.model.multi_turn_chat_completion(
-                self.system_call, self.all_history, []
-            )
-            print(f"divine: {self.index} > {result}")
+            result = await self.generate([], asyncio.get_running_loop().time() + self.talk_timeout)
+            records.record("divine", target=result)
             if result in target:
                 data = {"agentIdx": result}
             else:
@@ -318,12 +467,7 @@ class Agent:
         return json.dumps(data, separators=(",", ":"))
 
     def attack(self) -> str:
-        target = [
-            int(agent)
-            for agent in self.gameInfo["statusMap"]
-            if self.gameInfo["statusMap"][agent] == "ALIVE"
-        ]
-        target.remove(self.index)
+        target = self.state.targets()
         if self.day_count == 1:
             seer = [agent for agent, role in self.seer_dict.items() if agent in target and role == "seer"]
             if len(seer) == 2:
@@ -333,7 +477,7 @@ class Agent:
                 one = util.random_select(seer)
             else:
                 one = util.random_select(target)
-            print(f"attack: {self.index} > {one}")
+            records.record("attack", target=one)
             data = {"agentIdx": one}
         else:
             data = {"agentIdx": util.random_select(target)}
@@ -345,6 +489,23 @@ class Agent:
 
     def finish(self) -> str:
         self.gameContinue = False
+        # このエージェントのキャッシュの当たり外れ. ワーカープロセスの分は各model_callのcachedで分かる
+        if self.model.cache is not None:
+            records.record("cache", stats=self.model.cache.snapshot())
+        if self.speculation is not None:
+            self.speculation.discard()
+        # ワーカープロセスはプロセス内の他のエージェントや次のゲームでも使うので, このエージェントの分だけ止める
+        if self.workers is not None:
+            self.workers.cancel()
+            self.workers = None
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+    def run(self, coroutine):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coroutine)
 
     def action(self) -> str:
         if AIWolfCommand.is_initialize(request=self.request):
@@ -370,3 +531,11 @@ class Agent:
         elif AIWolfCommand.is_finish(request=self.request):
             self.finish()
         return ""
+
+    async def action_async(self) -> str:
+        """LLMを待つ要求をコルーチンで処理するaction. 1つのイベントループで複数のエージェントを動かす時に使う"""
+        if AIWolfCommand.is_talk(request=self.request):
+            return await self.talk_coroutine()
+        elif AIWolfCommand.is_divine(request=self.request):
+            return await self.divine_coroutine()
+        return self.action()
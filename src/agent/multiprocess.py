@@ -18,7 +18,7 @@ def execute_game(inifile:configparser.ConfigParser, name:str):
         received = None
 
         for _ in range(inifile.getint("game","num")):
-            received = establish.main(sock=sock, received=received, name=name)
+            received = establish.main(sock=sock, inifile=inifile, received=received, name=name)
         
         sock.close()
 
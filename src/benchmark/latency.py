@@ -0,0 +1,177 @@
+import argparse
+import configparser
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+from collections import defaultdict
+from multiprocessing.process import BaseProcess
+from pathlib import Path
+
+# establish/libはsrc/agentから実行される前提のモジュールなので, 同じ検索パスにする
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "agent"))
+
+from src.models.mock.main import Latency, MockConfig, serve  # noqa: E402
+from src.server.game import Game  # noqa: E402
+from src.server.main import connect_players  # noqa: E402
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    return ordered[min(int(len(ordered) * q / 100), len(ordered) - 1)]
+
+
+def summarize(samples: list[float], timeouts: int) -> dict[str, float | int]:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "timeouts": timeouts,
+        "p50": percentile(ordered, 50),
+        "p95": percentile(ordered, 95),
+        "p99": percentile(ordered, 99),
+        "max": ordered[-1],
+    }
+
+
+def compare(result: dict, baseline: dict) -> dict[str, dict[str, float]]:
+    """p95/p99 of each request type relative to a previous run (1.0 = unchanged)."""
+    ratios = {}
+    for key, stats in result["requests"].items():
+        before = baseline.get("requests", {}).get(key)
+        if before:
+            ratios[key] = {q: stats[q] / before[q] if before[q] else float("inf") for q in ("p95", "p99")}
+    return ratios
+
+
+def run_agent(inifile: configparser.ConfigParser, name: str, games: int, report) -> None:
+    """Serve games as one agent process and report how many processes it spawned and its peak RSS."""
+    import establish
+    import lib
+
+    spawned = [0]
+    # ワーカープールのForkProcessはmultiprocessing.Processを継承しないので, 共通の基底クラスで数える
+    start = BaseProcess.start
+
+    def counting_start(process) -> None:
+        spawned[0] += 1
+        start(process)
+
+    BaseProcess.start = counting_start
+    # 発話のprintはベンチマークの出力に混ぜない
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+    sock = lib.connection.TCPServer(inifile=inifile, name=name)
+    sock.connect()
+    received = None
+    for _ in range(games):
+        received = establish.main(sock=sock, inifile=inifile, received=received, name=name)
+    sock.close()
+    report.put({
+        "name": name,
+        "spawned": spawned[0],
+        # Linuxではキロバイト単位
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_max_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    })
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="リクエスト種別ごとの応答時間を計測する")
+    parser.add_argument("--config", default="./src/agent/config.ini")
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=5.0, help="サーバ側の応答制限時間(秒)")
+    parser.add_argument("--latency", default="lognormal:-0.7,0.4", help="モックAPIの応答時間分布")
+    parser.add_argument("--errors", default="", help='モックAPIのエラー率. 例: "429:0.05"')
+    parser.add_argument("--execution", default=None, help="async/processの上書き")
+    parser.add_argument("--port-base", type=int, default=51000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="結果のJSONを書き出すファイル. 省略時は標準出力")
+    parser.add_argument("--baseline", default=None, help="比較する過去の結果のJSON")
+    args = parser.parse_args()
+
+    mock = serve(MockConfig(
+        latency=Latency.parse(args.latency),
+        errors={int(status): float(rate) for status, rate in (item.split(":") for item in args.errors.split(",") if item)},
+        seed=args.seed,
+    ))
+    base_url = f"http://127.0.0.1:{mock.server_address[1]}"
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    os.environ.setdefault("OPENAI_ORG_ID", "mock")
+    os.environ.setdefault("GOOGLE_API_KEY", "mock")
+    os.environ.setdefault("GEMINI_API_KEY", "mock")
+
+    inifile = configparser.ConfigParser()
+    inifile.read(args.config, "UTF-8")
+    inifile["connection"]["host_flag"] = "true"
+    inifile["connection"]["ssh_flag"] = "false"
+    inifile["tcp-server"]["ip"] = "127.0.0.1"
+    inifile["model"]["base_url"] = f"{base_url}/v1"
+    inifile["cache"]["enable"] = "false"
+    if args.execution:
+        inifile["agent"]["execution"] = args.execution
+    agent_num = inifile.getint("agent", "num")
+    for i in range(agent_num):
+        inifile["tcp-server"][f"port{i + 1}"] = str(args.port_base + i)
+
+    report = multiprocessing.Queue()
+    agents = [
+        multiprocessing.Process(target=run_agent, args=(inifile, inifile.get("agent", f"name{i + 1}"), args.games, report))
+        for i in range(agent_num)
+    ]
+    for agent in agents:
+        agent.start()
+
+    samples: dict[str, list[float]] = defaultdict(list)
+    timeouts: dict[str, int] = defaultdict(int)
+
+    def on_response(request: str, day: int, turn: int, agent: int, elapsed: float, timed_out: bool) -> None:
+        keys = [request]
+        if request == "TALK":
+            keys.append(f"TALK/day{day}/talk{turn + 1}")
+        for key in keys:
+            samples[key].append(elapsed)
+            timeouts[key] += timed_out
+
+    players = connect_players(inifile, args.port_base)
+    rng = random.Random(args.seed)
+    start = time.monotonic()
+    winners: dict[str, int] = defaultdict(int)
+    for _ in range(args.games):
+        winners[Game(players, rng, args.timeout, on_response=on_response).run()] += 1
+    wall_time = time.monotonic() - start
+    agent_reports = sorted((report.get() for _ in agents), key=lambda r: r["name"])
+    for agent in agents:
+        agent.join()
+    for player in players:
+        player.close()
+    mock.shutdown()
+
+    result = {
+        "config": {
+            "games": args.games,
+            "timeout": args.timeout,
+            "latency": args.latency,
+            "errors": args.errors,
+            "execution": inifile.get("agent", "execution", fallback="async"),
+            "seed": args.seed,
+        },
+        "wall_time": wall_time,
+        "winners": dict(winners),
+        "requests": {key: summarize(samples[key], timeouts[key]) for key in sorted(samples)},
+        "agents": agent_reports,
+        "spawned_total": sum(r["spawned"] for r in agent_reports),
+    }
+    if args.baseline:
+        result["compared_to_baseline"] = compare(result, json.loads(Path(args.baseline).read_text(encoding="utf-8")))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import random
+import re
+import time
+from pathlib import Path
+
+from src.agent.lib import template
+from src.models.lib.normalize import DEFAULT, add_persona, for_persona
+
+NOISE = ["「", "」", "；", ";", ":", "：", "’", "'", "　", "(", ")", "XXX", "♪", ".", "私"]
+
+
+def chained(text: str) -> str:
+    """normalize_text before the single-pass normalizer, kept as the reference."""
+    text = re.sub(r"「|」", "", text)
+    text = re.sub(r"；|;", "", text)
+    text = re.sub(r":|：", "", text)
+    text = re.sub(r"’|'", "", text)
+    text = re.sub(r"　", "", text)
+    text = re.sub(r"\(|\)", "", text)
+    text = re.sub(r"XXX", "", text)
+    text = re.sub(r"♪", "", text)
+    text = re.sub(r"\.", "。", text)
+    return text
+
+
+def synthetic(count: int, rng: random.Random) -> list[str]:
+    """Utterances of template.py with the characters normalize_text removes scattered in."""
+    sources = [
+        text
+        for texts in (template.DAY1_MORNING, template.DAY2_MORNING, template.DAY1_EVENING)
+        for text in texts
+        if text
+    ]
+    utterances = []
+    for _ in range(count):
+        chars = list(rng.choice(sources))
+        for _ in range(rng.randint(0, 6)):
+            chars.insert(rng.randrange(len(chars) + 1), rng.choice(NOISE))
+        utterances.append("".join(chars))
+    return utterances
+
+
+def from_logs(pattern: str) -> list[str]:
+    """Talk texts of the tournament logs matched by pattern (the format log_to_json reads)."""
+    utterances = []
+    for log_file in Path().glob(pattern):
+        with open(log_file, encoding="utf-8") as f:
+            for row in f:
+                fields = row.rstrip("\r\n").split(",", 5)
+                if len(fields) == 6 and fields[1] == "talk":
+                    utterances.append(fields[5])
+    return utterances
+
+
+def measure(normalize, utterances: list[str], repeat: int) -> float:
+    """Best utterances per second out of repeat runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in utterances:
+            normalize(text)
+        best = min(best, time.perf_counter() - start)
+    return len(utterances) / best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="発話の正規化の処理速度を計測する")
+    parser.add_argument("--count", type=int, default=200000, help="生成する発話の数")
+    parser.add_argument("--logs", default=None, help='過去大会のログのglob. 例: "data/*.log"')
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    utterances = from_logs(args.logs) if args.logs else synthetic(args.count, random.Random(args.seed))
+    mismatches = sum(chained(text) != DEFAULT(text) for text in utterances)
+    print(f"utterances: {len(utterances)} ({sum(map(len, utterances))} chars), mismatches: {mismatches}")
+    baseline = measure(chained, utterances, args.repeat)
+    # キャラクターごとの置き換えは既定では無いので, 計測用に1つ追加する
+    add_persona("Agent[02]", {"私": "ワシ"})
+    for name, normalize in [("chained re.sub", chained), ("Normalizer", DEFAULT), ("Normalizer (Agent[02])", for_persona("Agent[02]"))]:
+        throughput = baseline if normalize is chained else measure(normalize, utterances, args.repeat)
+        print(f"{name:<24} {throughput:>12,.0f} utterances/s  x{throughput / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
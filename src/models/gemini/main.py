@@ -1,22 +1,66 @@
 import concurrent.futures
 import json
 import os
+import threading
 import time
-from typing import Optional
+from typing import Callable, Optional
 
 import google.generativeai as genai
-import requests
+import httpx
 from retry import retry
 
-from src.models.gpt.main import GptClass
+from src.models.lib.cache import ResponseCache
+from src.models.lib.client import get_client
+from src.models.lib import records, tracing
 from src.models.lib.generate_message import make_messages
+from src.models.lib.names import name
 from src.models.lib.prompt import *
-from src.models.lib.utils import (get_chat_history,
-                                  make_unified_prompt_from_list, output_log)
+from src.models.lib.rerank import Score, choose
+from src.models.lib.rerank import score as default_score
+from src.models.lib.stream import stream_first_sentence
+from src.models.lib.tokens import get_encoding
+from src.models.lib.utils import get_chat_history
+
+
+def gemini_delta(event: dict) -> str:
+    """Text of a streamed event. The last event may carry only finishReason without content."""
+    candidates = event.get("candidates") or [{}]
+    parts = candidates[0].get("content", {}).get("parts") or [{}]
+    return parts[0].get("text", "")
+
+
+def unsupported_candidates(response: httpx.Response) -> bool:
+    """Whether a failed request was rejected because the model returns only one candidate."""
+    try:
+        text = response.text
+    except Exception:
+        return False
+    return response.status_code == 400 and "candidate" in text.lower()
 
 
 class GeminiClass:
-    def __init__(self) -> None:
+    _executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+    _executor_pid: Optional[int] = None
+    _executor_lock = threading.Lock()
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        http2: bool = False,
+        stream: bool = False,
+        cache: Optional[ResponseCache] = None,
+        base_url: Optional[str] = None,
+        budgets: Optional[dict[str, int]] = None,
+        score: Optional[Score] = None,
+    ) -> None:
+        self.cache = cache
+        # 複数候補から1つを選ぶ採点関数. 選ぶためにモデルを呼び直さない
+        self.score: Score = score or default_score
+        # リクエスト種別ごとのプロンプトのトークン数の上限. 無い種別は履歴を全て入れる
+        self.budgets: dict[str, int] = budgets or {}
+        if self.budgets:
+            # 最初の要求で読み込まないよう, ここでトークナイザを用意しておく
+            get_encoding()
         genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
         self.model: str = "gemini-pro"
         self.max_tokens: int = 500
@@ -24,8 +68,21 @@ class GeminiClass:
         self.temperature: float = 0.7
         self.candidate: int = 1
         self.timeout_seconds: float = 4.5
-        self.url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key={os.environ['GEMINI_API_KEY']}"
+        # モックサーバなどに向ける場合はbase_urlかGEMINI_BASE_URLで上書きする
+        base_url = (base_url or os.getenv("GEMINI_BASE_URL") or "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+        self.url = f"{base_url}/models/gemini-pro:generateContent?key={os.environ['GEMINI_API_KEY']}"
+        self.stream_url = f"{base_url}/models/gemini-pro:streamGenerateContent?alt=sse&key={os.environ['GEMINI_API_KEY']}"
+        self.stream: bool = stream  # talkを1文目で打ち切るストリーミング生成
         self.header = {"Content-Type": "application/json"}
+        self.pool_size: int = pool_size
+        self.http2: bool = http2
+        # 1リクエストで複数候補を返せるか. 400が返れば以降は1候補ずつ投げる
+        self.native_candidates: bool = True
+
+    @property
+    def client(self):
+        # fork先のプロセスでは親の接続を使わないよう, 毎回プロセスごとのクライアントを引く
+        return get_client(self.pool_size, self.http2)
 
     def make_gemini_format_message(
         self,
@@ -33,9 +90,10 @@ class GeminiClass:
         chat_history: list[dict[str, str | int]],
         towards_me: list[dict[str, str]] = [],
     ) -> str:
-        system_prompt, user_prompt = make_messages(
-            system_call, chat_history, towards_me
-        )
+        with tracing.span("make_messages"):
+            system_prompt, user_prompt = make_messages(
+                system_call, chat_history, towards_me, self.budgets.get(system_call["request"])
+            )
         content_message: str = system_prompt + "\n## やるべきこと\n" + user_prompt
         return content_message
 
@@ -47,7 +105,9 @@ class GeminiClass:
         towards_me: list[dict[str, str]] = [],
         is_multi_process: bool = False,
         n_samples: int = 3,
-        next_model: Optional[str] = "gemini-pro",
+        next_model: Optional[str] = "gemini-pro",  # 使わない. 候補はrerankで選ぶ
+        model: Optional[str] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None,
     ) -> str:
         start_time = time.time()
         messages: list[dict[str, str]] = [
@@ -62,103 +122,156 @@ class GeminiClass:
                 },
             },
         ]
-        if is_multi_process and n_samples > 1 and next_model:
-            # 並列処理
-            # 並列化させるためにnコのpromptを作成
-            prompts: list[list[dict[str, str]]] = [messages] * n_samples
-
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                responses: list[str] = list(
-                    executor.map(
-                        lambda prompt: requests.post(
-                            url=self.url,
-                            headers=self.header,
-                            json={
-                                "contents": prompt,
-                                "safety_settings": {
-                                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                                    "threshold": "BLOCK_LOW_AND_ABOVE",
-                                },
-                                "generation_config": {
-                                    "max_output_tokens": self.max_tokens,
-                                    "stop_sequences": self.stop_words,
-                                    "temperature": self.temperature,
-                                    "candidate_count": self.candidate,
-                                },
-                            },
-                            timeout=self.timeout_seconds,
-                        ).json(),
-                        prompts,
-                    )
-                )
-                if "gemini" in next_model:
-                    response = self.chat_completion(
-                        make_unified_prompt_from_list(responses)
-                    )
-                else:
-                    raise "next_modelは循環参照を避けるためにGeminiのみ対応しています"
-                    response = GptClass().chat_completion(
-                        make_unified_prompt_from_list("", responses)
-                    )
+        if is_multi_process and n_samples > 1:
+            deadline = time.monotonic() + self.timeout_seconds
+            candidates = self.sample(messages, n_samples, model or self.model, deadline)
+            response = choose(candidates, system_call, chat_history, self.score) or "Timeout"
+            records.model_call(model or self.model, system_call["request"], time.time() - start_time, response, messages)
         else:
             # 同期処理
+            payload = {
+                "contents": messages,
+                "safety_settings": {
+                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                    "threshold": "BLOCK_LOW_AND_ABOVE",
+                },
+                "generation_config": self.generation_config(self.candidate),
+            }
+            response = self.complete(payload, system_call["request"], model, is_cancelled)
+        return response
+
+    @classmethod
+    def executor(cls) -> concurrent.futures.ThreadPoolExecutor:
+        """Threads shared by every instance in this process, created on first use."""
+        with cls._executor_lock:
+            if cls._executor is None or cls._executor_pid != os.getpid():
+                cls._executor = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="gemini")
+                cls._executor_pid = os.getpid()
+            return cls._executor
+
+    def generation_config(self, candidate_count: int) -> dict:
+        return {
+            "max_output_tokens": self.max_tokens,
+            "stop_sequences": self.stop_words,
+            "temperature": self.temperature,
+            "candidate_count": candidate_count,
+        }
+
+    def post_candidates(self, messages: list[dict], candidate_count: int, model: str, timeout: float) -> list[str]:
+        response = self.client.post(
+            url=self.url.replace(self.model, model),
+            headers=self.header,
+            json={
+                "contents": messages,
+                "safety_settings": {
+                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                    "threshold": "BLOCK_LOW_AND_ABOVE",
+                },
+                "generation_config": self.generation_config(candidate_count),
+            },
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        return [
+            candidate["content"]["parts"][0]["text"]
+            for candidate in response.json().get("candidates", [])
+            if candidate.get("content", {}).get("parts")
+        ]
+
+    def sample(self, messages: list[dict], n_samples: int, model: str, deadline: float) -> list[str]:
+        """Up to n_samples generations that arrive before deadline (time.monotonic()).
+
+        One request with candidate_count=n_samples when the model supports it. Otherwise
+        n_samples requests of one candidate each on the shared executor, keeping the ones that
+        finished in time.
+        """
+        if self.native_candidates:
             try:
-                response_json = requests.post(
-                    url=self.url,
+                with tracing.span("model_call", model=model, model_request="candidates"):
+                    return self.post_candidates(messages, n_samples, model, max(deadline - time.monotonic(), 0))
+            except httpx.HTTPStatusError as error:
+                # プロンプトが長すぎる等の400では切り替えない. 1候補ずつ投げても同じく失敗する
+                if not unsupported_candidates(error.response):
+                    return []
+                # candidate_countが2以上に対応していないモデル. 以降は1候補ずつ投げる
+                self.native_candidates = False
+            except Exception:
+                return []
+        futures = [
+            self.executor().submit(self.post_candidates, messages, 1, model, max(deadline - time.monotonic(), 0))
+            for _ in range(n_samples)
+        ]
+        done, not_done = concurrent.futures.wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        for future in not_done:
+            future.cancel()
+        return [text for future in futures if future in done and future.exception() is None for text in future.result()]
+
+    @retry(tries=3, backoff=0, jitter=0, max_delay=None, delay=0.3)
+    def chat_completion(self, input_text: str, request: str = "chat") -> str:
+        return self.complete(
+            {
+                "contents": {"role": "user", "parts": {"text": input_text}},
+                "safety_settings": {
+                    "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+                    "threshold": "BLOCK_LOW_AND_ABOVE",
+                },
+                "generation_config": self.generation_config(self.candidate),
+            },
+            request,
+        )
+
+    def complete(
+        self,
+        payload: dict,
+        request: str,
+        model: Optional[str] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+    ) -> str:
+        """payloadを送って生成文を返す. キャッシュ対象の要求ならキャッシュから返す"""
+        model = model or self.model
+        usage: dict = {}
+        called = False
+
+        def call() -> str:
+            nonlocal called
+            called = True
+            try:
+                if self.stream and request in ("talk", "strike"):
+                    # 1文が揃った時点で打ち切る
+                    return stream_first_sentence(
+                        self.client,
+                        self.stream_url.replace(self.model, model),
+                        self.header,
+                        payload,
+                        gemini_delta,
+                        self.timeout_seconds,
+                        is_cancelled,
+                    )
+                response_json = self.client.post(
+                    url=self.url.replace(self.model, model),
                     headers=self.header,
-                    json={
-                        "contents": messages,
-                        "safety_settings": {
-                            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                            "threshold": "BLOCK_LOW_AND_ABOVE",
-                        },
-                        "generation_config": {
-                            "max_output_tokens": self.max_tokens,
-                            "stop_sequences": self.stop_words,
-                            "temperature": self.temperature,
-                            "candidate_count": self.candidate,
-                        },
-                    },
+                    json=payload,
                     timeout=self.timeout_seconds,
                 ).json()
-                response = response_json["candidates"][0]["content"]["parts"][0]["text"]
+                usage.update(response_json.get("usageMetadata") or {})
+                return response_json["candidates"][0]["content"]["parts"][0]["text"]
             except:
                 # TODO: 5s以内で返答が帰ってこなかった場合
-                response = "Timeout"
-        elapsed_time: float = time.time() - start_time
-        output_log(self.model, response, elapsed_time, messages, response)
-        return response
+                return "Timeout"
 
-    @retry(tries=3, backoff=0, jitter=0, max_delay=None, delay=0.3)
-    def chat_completion(self, input_text: str) -> str:
-        try:
-            response_json = requests.post(
-                url=self.url,
-                headers=self.header,
-                json={
-                    "contents": {"role": "user", "parts": {"text": input_text}},
-                    "safety_settings": {
-                        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                        "threshold": "BLOCK_LOW_AND_ABOVE",
-                    },
-                    "generation_config": {
-                        "max_output_tokens": self.max_tokens,
-                        "stop_sequences": self.stop_words,
-                        "temperature": self.temperature,
-                        "candidate_count": self.candidate,
-                    },
-                },
-                timeout=self.timeout_seconds,
-            ).json()
-            response = response_json["candidates"][0]["content"]["parts"][0]["text"]
-        except:
-            # TODO: 5s以内で返答が帰ってこなかった場合
-            response = "Timeout"
+        start = time.perf_counter()
+        with tracing.span("model_call", model=model, model_request=request):
+            if self.cache is None:
+                response = call()
+            else:
+                response = self.cache.fetch(request, "gemini", {"model": model, **payload}, call)
+        # トークン数と料金はrecordsのスレッドで数える
+        records.model_call(model, request, time.perf_counter() - start, response, payload["contents"], usage, not called)
         return response
 
     def summarize_day(self, chat_history: list[dict[str, str | int]], day: int) -> str:
         user_prompt: str = get_chat_history(chat_history) + DAY_SUMMARY_END.format(day)
-        return self.chat_completion(DAY_SUMMARY_START.format(day) + "\n" + user_prompt)
+        return self.chat_completion(DAY_SUMMARY_START.format(day) + "\n" + user_prompt, "summarize")
 
 
 def main() -> None:
@@ -167,7 +280,7 @@ def main() -> None:
     alive_agents = ["Agent[01]", "Agent[02]", "Agent[03]", "Agent[04]", "Agent[05]"]
     system_call = {
         "request": "talk",
-        "idx": f"Agent[0{index}]",
+        "idx": name(index),
         "alive": ", ".join(alive_agents),
         "behavior": "SEER",
     }
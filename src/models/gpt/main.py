@@ -1,21 +1,51 @@
 import json
 import os
-import re
+import time
+from typing import Callable, Optional
 
-import requests
-from openai import OpenAI
 from retry import retry
 
-from src.models.lib.generate_message import make_messages
+from src.models.lib.cache import ResponseCache
+from src.models.lib.client import get_client
+from src.models.lib import records, tracing
+from src.models.lib.fewshot import FewShot
+from src.models.lib.generate_message import make_declare_messages, make_messages
+from src.models.lib.history import format_talk
+from src.models.lib.names import name
 from src.models.lib.prompt import *
-from src.models.lib.utils import (get_chat_history,
-                                  make_unified_prompt_from_list,
-                                  normalize_text)
+from src.models.lib.rerank import Score, choose
+from src.models.lib.rerank import score as default_score
+from src.models.lib.stream import stream_first_sentence
+from src.models.lib.tokens import fit_newest, get_encoding
+from src.models.lib.normalize import clean_talk, digits
+from src.models.lib.utils import get_chat_history
 
 
 class GptClass:
-    def __init__(self) -> None:
-        self.client = OpenAI()
+    def __init__(
+        self,
+        pool_size: int = 10,
+        http2: bool = False,
+        stream: bool = False,
+        cache: Optional[ResponseCache] = None,
+        base_url: Optional[str] = None,
+        budgets: Optional[dict[str, int]] = None,
+        score: Optional[Score] = None,
+        fewshot: Optional[FewShot] = None,
+    ) -> None:
+        self.cache = cache
+        # 投票先/占い結果の解析で, 固定の例の代わりに過去の似た発話を例にする
+        self.fewshot = fewshot
+        # 複数候補から1つを選ぶ採点関数. 選ぶためにモデルを呼び直さない
+        self.score: Score = score or default_score
+        # リクエスト種別ごとのプロンプトのトークン数の上限. 無い種別は履歴を全て入れる
+        self.budgets: dict[str, int] = budgets or {}
+        if self.budgets:
+            # 最初の要求で読み込まないよう, ここでトークナイザを用意しておく
+            get_encoding()
+        self.pool_size: int = pool_size
+        self.http2: bool = http2
+        self.stream: bool = stream  # talkを1文目で打ち切るストリーミング生成
         self.max_tokens: int = 200
         self.n: int = 1  # 原則使わない
         self.stop_words = None
@@ -23,7 +53,26 @@ class GptClass:
         self.presence_penalty: float = 0.0
         self.frequency_penalty: float = 0.0
         self.timeout_seconds: float = 4.5
-        self.url = "https://api.openai.com/v1/chat/completions"
+        # モックサーバなどに向ける場合はbase_urlかOPENAI_BASE_URLで上書きする
+        base_url = base_url or os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+
+    @property
+    def client(self):
+        # fork先のプロセスでは親の接続を使わないよう, 毎回プロセスごとのクライアントを引く
+        return get_client(self.pool_size, self.http2)
+
+    @staticmethod
+    def headers() -> dict[str, str]:
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY"),
+        }
+        # 未設定のヘッダをNoneで渡すとhttpxは例外を出すので, 設定されている時だけ付ける
+        organization = os.getenv("OPENAI_ORG_ID")
+        if organization:
+            headers["OpenAI-Organization"] = organization
+        return headers
 
     def make_gpt_format_message(
         self,
@@ -31,9 +80,10 @@ class GptClass:
         chat_history: list[dict[str, str | int]],
         towards_me: list[dict[str, str]] = [],
     ) -> str:
-        system_prompt, user_prompt = make_messages(
-            system_call, chat_history, towards_me
-        )
+        with tracing.span("make_messages"):
+            system_prompt, user_prompt = make_messages(
+                system_call, chat_history, towards_me, self.budgets.get(system_call["request"])
+            )
         return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
@@ -48,19 +98,19 @@ class GptClass:
         model: str = "gpt-3.5-turbo",
         is_multi_process: bool = False,
         n_samples: int = 1,
+        is_cancelled: Optional[Callable[[], bool]] = None,
     ) -> str:
         messages: list[dict[str, str]] = self.make_gpt_format_message(
             system_call, chat_history, towards_me
         )
 
         if is_multi_process and n_samples > 1:
+            start = time.perf_counter()
+            responses_json: dict = {}
             try:
-                responses_json = requests.post(
+                responses_json = self.client.post(
                     url=self.url,
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY"),
-                    },
+                    headers=self.headers(),
                     json={
                         "model": model,
                         "messages": messages,
@@ -73,62 +123,17 @@ class GptClass:
                     },
                     timeout=self.timeout_seconds,
                 ).json()
-                responses: list[str] = [
-                    responses_json["choices"][i]["message"]["content"]
-                    for i in range(n_samples)
-                ]
-                response = self.chat_completion(
-                    "", make_unified_prompt_from_list("", responses)
-                )
-            except:
-                # サーバーエラーもこっちに飛ぶ
-                response = "Timeout"
-        else:
-            try:
-                response_json = requests.post(
-                    url=self.url,
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY"),
-                        "OpenAI-Organization": os.getenv("OPENAI_ORG_ID"),
-                    },
-                    json={
-                        "model": model,
-                        "messages": messages,
-                        "temperature": self.temperature,
-                        "max_tokens": self.max_tokens,
-                        "stop": self.stop_words,
-                        "presence_penalty": self.presence_penalty,
-                        "frequency_penalty": self.frequency_penalty,
-                    },
-                    timeout=self.timeout_seconds,
-                ).json()
-                response: str = response_json["choices"][0]["message"]["content"]
+                responses: list[str] = [choice["message"]["content"] for choice in responses_json["choices"]]
+                response = choose(responses, system_call, chat_history, self.score) or "Timeout"
             except:
                 # サーバーエラーもこっちに飛ぶ
                 response = "Timeout"
-        result = response.replace("\n", "")
-        if system_call["request"] == "vote" or system_call["request"] == "divine" or system_call["request"] == "attack":
-            result = int(re.sub(r"\D", "", result))
+            records.model_call(
+                model, system_call["request"], time.perf_counter() - start, response, messages, responses_json.get("usage")
+            )
         else:
-            result = re.sub(r"Agent\[0\d\]: ", "", result)
-            result = normalize_text(result)
-        return result
-
-    def chat_completion(self, system_prompt: str, user_prompt: str, model: str = "gpt-3.5-turbo") -> str:
-        messages: list[dict[str, str]] = [
-            {"role": "user", "content": user_prompt},
-            {"role": "system", "content": system_prompt},
-        ]
-        try:
-            response_json = requests.post(
-                url=self.url,
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": "Bearer " + os.getenv("OPENAI_API_KEY"),
-                    "OpenAI-Organization": os.getenv("OPENAI_ORG_ID"),
-                },
-                json={
+            response = self.complete(
+                {
                     "model": model,
                     "messages": messages,
                     "temperature": self.temperature,
@@ -137,63 +142,128 @@ class GptClass:
                     "presence_penalty": self.presence_penalty,
                     "frequency_penalty": self.frequency_penalty,
                 },
-                timeout=self.timeout_seconds,
-            ).json()
-            response = response_json["choices"][0]["message"]["content"]
-        except:
-            # サーバーエラーもこっちに飛ぶ
-            response = "Timeout"
+                system_call["request"],
+                is_cancelled,
+            )
+        if system_call["request"] == "vote" or system_call["request"] == "divine" or system_call["request"] == "attack":
+            return int(digits(response))
+        return clean_talk(response, system_call["idx"])
+
+    def chat_completion(self, system_prompt: str, user_prompt: str, model: str = "gpt-3.5-turbo", request: str = "chat") -> str:
+        messages: list[dict[str, str]] = [
+            {"role": "user", "content": user_prompt},
+            {"role": "system", "content": system_prompt},
+        ]
+        return self.complete(
+            {
+                "model": model,
+                "messages": messages,
+                "temperature": self.temperature,
+                "max_tokens": self.max_tokens,
+                "stop": self.stop_words,
+                "presence_penalty": self.presence_penalty,
+                "frequency_penalty": self.frequency_penalty,
+            },
+            request,
+        )
+
+    def complete(self, payload: dict, request: str, is_cancelled: Optional[Callable[[], bool]] = None) -> str:
+        """payloadを送って生成文を返す. キャッシュ対象の要求ならキャッシュから返す"""
+        usage: dict = {}
+        called = False
+
+        def call() -> str:
+            nonlocal called
+            called = True
+            headers = self.headers()
+            try:
+                if self.stream and request in ("talk", "strike"):
+                    # 1文が揃った時点で打ち切る
+                    return stream_first_sentence(
+                        self.client,
+                        self.url,
+                        headers,
+                        {**payload, "stream": True},
+                        lambda event: (event["choices"][0]["delta"].get("content") or "") if event["choices"] else "",
+                        self.timeout_seconds,
+                        is_cancelled,
+                    )
+                response_json = self.client.post(
+                    url=self.url,
+                    headers=headers,
+                    json=payload,
+                    timeout=self.timeout_seconds,
+                ).json()
+                usage.update(response_json.get("usage") or {})
+                return response_json["choices"][0]["message"]["content"]
+            except:
+                # サーバーエラーもこっちに飛ぶ
+                return "Timeout"
+
+        start = time.perf_counter()
+        with tracing.span("model_call", model=payload["model"], model_request=request):
+            response = call() if self.cache is None else self.cache.fetch(request, "openai", payload, call)
+        # トークン数と料金はrecordsのスレッドで数える
+        records.model_call(
+            payload["model"], request, time.perf_counter() - start, response, payload["messages"], usage, not called
+        )
         return response
 
     def summarize_day(self, chat_history: list[dict[str, str | int]], day: int) -> str:
         user_prompt: str = get_chat_history(chat_history) + DAY_SUMMARY_END.format(day)
-        return self.chat_completion(DAY_SUMMARY_START.format(day), user_prompt)
+        return self.chat_completion(DAY_SUMMARY_START.format(day), user_prompt, request="summarize")
     
-    def vote_declare(self, chat_history: list[dict[str, str | int]], idx: int, queue):
-        system_prompt: str = SYSTEM_VOTE_DECLARE.format(get_chat_history(chat_history), str(idx))
-        user_prompt: str = USER_VOTE_DECLARE
-        result = self.chat_completion(system_prompt, user_prompt, "gpt-4o-mini")
-        vote_dict = {}
+    def vote_declare(
+        self, chat_history: list[dict[str, str | int]], idx: int, queue=None, known: str = ""
+    ) -> dict[int, int] | None:
+        """Votes declared in chat_history. None when the model did not answer.
+
+        known is the summary of the votes found in earlier talks, so that chat_history only
+        needs the talks since the last analysis.
+        """
+        talks = fit_newest([format_talk(talk) for talk in chat_history], self.budgets.get("vote_declare"))
+        examples = self.fewshot.search("vote", chat_history) if self.fewshot else []
+        system_prompt, user_prompt = make_declare_messages("vote", talks, idx, known, examples)
+        result = self.chat_completion(system_prompt, user_prompt, "gpt-4o-mini", "vote_declare")
+        vote_dict = None if result == "Timeout" else {}
         if result != "Timeout" and "one" not in result:
             vote_list = result.split("\n")
             for vote in vote_list:
                 try:
-                    vote = re.sub(r"\D", "", vote)
+                    vote = digits(vote)
                     actor = int(vote[1])
                     target = int(vote[3])
                     if actor != 6:
                         vote_dict[actor] = target
                 except:
                     pass
-        queue.put(vote_dict)
+        if queue is not None:
+            queue.put(vote_dict)
+        return vote_dict
     
-    def seer_declare(self, chat_history: list[dict[str, str | int]], idx: int, queue):
-        system_prompt: str = SYSTEM_SEER_DECLARE.format(get_chat_history(chat_history), str(idx))
-        user_prompt: str = USER_SEER_DECLARE
-        result = self.chat_completion(system_prompt, user_prompt, "gpt-4o-mini")
-        seer_info = []
+    def seer_declare(
+        self, chat_history: list[dict[str, str | int]], idx: int, queue=None, known: str = ""
+    ) -> list[dict[str, int | str]] | None:
+        """Seer claims in chat_history. None when the model did not answer. known works as in vote_declare."""
+        talks = fit_newest([format_talk(talk) for talk in chat_history], self.budgets.get("seer_declare"))
+        examples = self.fewshot.search("seer", chat_history) if self.fewshot else []
+        system_prompt, user_prompt = make_declare_messages("seer", talks, idx, known, examples)
+        result = self.chat_completion(system_prompt, user_prompt, "gpt-4o-mini", "seer_declare")
+        seer_info = None if result == "Timeout" else []
         if result != "Timeout" and "one" not in result:
             seer_list = result.split("\n")
             for seer in seer_list:
                 try:
                     actor, target, report = seer.split(", ")
-                    actor = int(re.sub(r"\D", "", actor))
-                    target = int(re.sub(r"\D", "", target))
+                    actor = int(digits(actor))
+                    target = int(digits(target))
                     if actor != 6:
                         seer_info.append({"actor": actor, "target": target, "report": report})
                 except:
                     pass
-        queue.put(seer_info)
-    
-    def pipe_model2agent(
-        self,
-        system_call: dict[str, str],
-        chat_history: list[dict[str, str | int]],
-        towards_me: list[dict[str, str]] = [],
-        queue = None,
-        ) -> None:
-        result = self.multi_turn_chat_completion(system_call, chat_history, towards_me)
-        queue.put(result)
+        if queue is not None:
+            queue.put(seer_info)
+        return seer_info
 
 
 def main() -> None:
@@ -202,7 +272,7 @@ def main() -> None:
     alive_agents = ["Agent[01]", "Agent[02]", "Agent[03]", "Agent[04]", "Agent[05]"]
     system_call = {
         "request": "talk",
-        "idx": f"Agent[0{index}]",
+        "idx": name(index),
         "alive": ", ".join(alive_agents),
         "behavior": "SEER",
     }
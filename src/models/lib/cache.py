@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+# 既定でキャッシュする要求. どのモデル呼び出しも同じ温度でサンプリングしているが, 投票宣言/占い結果の
+# 抽出は同じ発話に対して同じ答えが正しい. 占い先や投票先などの判断はサンプリングのばらつきが戦略なので再利用しない
+DEFAULT_REQUESTS = ("vote_declare", "seer_declare")
+
+
+class ResponseCache:
+    """Cache of model responses keyed on a hash of the provider and the request body.
+
+    Responses are kept in a bounded in-memory LRU and, when a path is given, in a SQLite
+    file shared by every process on the host. Entries on disk expire after ttl seconds and the
+    oldest entries are evicted once there are more than disk_size of them.
+    Only the request types in `requests` are cached.
+    """
+
+    def __init__(
+        self,
+        memory_size: int = 1024,
+        path: Optional[str] = None,
+        ttl: float = 7 * 24 * 3600,
+        disk_size: int = 100000,
+        requests: Iterable[str] = DEFAULT_REQUESTS,
+    ) -> None:
+        self.memory_size = memory_size
+        self.path = path
+        self.ttl = ttl
+        self.disk_size = disk_size
+        self.requests = set(requests)
+        self.memory: OrderedDict[str, str] = OrderedDict()
+        self.stats: dict[str, dict[str, int]] = {}
+        self.lock = threading.Lock()
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_pid: Optional[int] = None
+        self.puts = 0
+
+    @staticmethod
+    def make_key(provider: str, payload: dict) -> str:
+        """Hash of the provider and the request body (model, messages and sampling params)."""
+        body = json.dumps([provider, payload], ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+    def fetch(self, request: str, provider: str, payload: dict, call: Callable[[], str]) -> str:
+        """Return the cached response or call the model and cache its answer.
+
+        Args:
+            request (str): request type such as "talk" or "vote_declare"
+            provider (str): "openai" or "gemini"
+            payload (dict): request body sent to the provider
+            call (Callable[[], str]): calls the model. "Timeout" is never cached.
+
+        Returns:
+            str: response text
+        """
+        if request not in self.requests:
+            return call()
+        key = self.make_key(provider, payload)
+        response = self.get(key)
+        with self.lock:
+            counter = self.stats.setdefault(request, {"hit": 0, "miss": 0})
+            counter["hit" if response is not None else "miss"] += 1
+        if response is not None:
+            return response
+        response = call()
+        if response != "Timeout":
+            self.put(key, response)
+        return response
+
+    def snapshot(self) -> dict[str, dict[str, int]]:
+        """Hits and misses so far per request type, e.g. {"vote_declare": {"hit": 3, "miss": 5}}."""
+        with self.lock:
+            return {request: dict(counter) for request, counter in self.stats.items()}
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            response = self.memory.get(key)
+            if response is not None:
+                self.memory.move_to_end(key)
+                return response
+            db = self.connect()
+            if db is None:
+                return None
+            try:
+                row = db.execute(
+                    "SELECT response FROM responses WHERE key = ? AND created > ?",
+                    (key, time.time() - self.ttl),
+                ).fetchone()
+            except sqlite3.Error:
+                # 他のプロセスが書き込み中なら, キャッシュなしとして扱う
+                return None
+            if row is None:
+                return None
+            self.remember(key, row[0])
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        with self.lock:
+            self.remember(key, response)
+            db = self.connect()
+            if db is None:
+                return
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)",
+                    (key, response, time.time()),
+                )
+                self.puts += 1
+                # 件数の確認は書き込み100回に1回だけ行う
+                if self.puts % 100 == 0:
+                    self.evict(db)
+                db.commit()
+            except sqlite3.Error:
+                db.rollback()
+
+    def remember(self, key: str, response: str) -> None:
+        self.memory[key] = response
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def evict(self, db: sqlite3.Connection) -> None:
+        db.execute("DELETE FROM responses WHERE created <= ?", (time.time() - self.ttl,))
+        (count,) = db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.disk_size:
+            db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created LIMIT ?)",
+                (count - self.disk_size,),
+            )
+
+    def connect(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        # fork先では親の接続を使わない
+        if self.db is None or self.db_pid != os.getpid():
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=1.0, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+            self.db_pid = os.getpid()
+        return self.db
@@ -0,0 +1,56 @@
+import atexit
+import os
+import threading
+
+import httpx
+from loguru import logger
+
+_clients: dict[tuple[int, int, bool], httpx.Client] = {}
+_lock = threading.Lock()
+
+
+def get_client(pool_size: int = 10, http2: bool = False, keepalive_expiry: float = 60.0) -> httpx.Client:
+    """Get the HTTP client shared by every model class in this process.
+
+    The client keeps connections alive, so the TCP and TLS handshakes are paid once per host
+    instead of once per request. A forked child never reuses the parent's sockets.
+
+    Args:
+        pool_size (int, optional): Maximum number of connections. Defaults to 10.
+        http2 (bool, optional): Multiplex requests over HTTP/2 when the h2 package is installed. Defaults to False.
+        keepalive_expiry (float, optional): Seconds an idle connection is kept. Defaults to 60.0.
+
+    Returns:
+        httpx.Client: pooled client
+    """
+    key = (os.getpid(), pool_size, http2)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    logger.warning("h2 is not installed. Falling back to HTTP/1.1")
+                    http2 = False
+            client = httpx.Client(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+            )
+            # 同じプロセスの他のエージェントや次のゲームも使うので, 閉じるのはプロセスの終了時
+            if not any(other[0] == key[0] for other in _clients):
+                atexit.register(close_clients)
+            _clients[key] = client
+    return client
+
+
+def close_clients() -> None:
+    """Close the clients created in this process. Registered with atexit by get_client."""
+    pid = os.getpid()
+    with _lock:
+        for key in [key for key in _clients if key[0] == pid]:
+            _clients.pop(key).close()
@@ -0,0 +1,292 @@
+import argparse
+import glob
+import hashlib
+import json
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from src.models.lib.log_to_json import parse_row
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    source TEXT NOT NULL,
+    digest TEXT NOT NULL UNIQUE  -- ファイルの内容のSHA-256. 同じゲームを2度取り込まない
+);
+CREATE TABLE IF NOT EXISTS talks (
+    id INTEGER PRIMARY KEY,
+    game INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    turn INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    agent INTEGER NOT NULL,
+    role TEXT,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS talks_game_day_agent ON talks (game, day, agent);
+CREATE INDEX IF NOT EXISTS talks_day_agent ON talks (day, agent);
+CREATE INDEX IF NOT EXISTS talks_role_day ON talks (role, day);
+-- 各エージェントの最初の占いCO. talkが小さいほど早い
+CREATE TABLE IF NOT EXISTS seer_cos (
+    talk INTEGER PRIMARY KEY,
+    game INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    agent INTEGER NOT NULL,
+    target INTEGER,
+    report TEXT
+);
+CREATE INDEX IF NOT EXISTS seer_cos_game ON seer_cos (game, talk);
+CREATE INDEX IF NOT EXISTS seer_cos_day ON seer_cos (day);
+CREATE VIRTUAL TABLE IF NOT EXISTS talks_fts USING fts5 (text, content='talks', content_rowid='id', tokenize='trigram');
+"""
+# 結果を伴わない占いCO. 例: 占い師COするのだ, ワタクシが占い師ですわ
+SEER_CO = re.compile(r"占い師(?:として)?(?:CO|です|だ|や|じゃ)|占いCO")
+# trigramは3文字未満の語を探せない
+MIN_FTS_CHARS = 3
+
+
+@dataclass
+class Ingested:
+    """Result of ingesting one file."""
+
+    game: str
+    talks: int = 0
+    rejected: int = 0
+    duplicate_of: Optional[str] = None  # 同じ内容のファイルを取り込み済みならその元のファイル. 取り込まない
+    collided: bool = False  # 内容の違う同じ名前のゲームがあったので, 名前に内容のハッシュを付けた
+
+    @property
+    def skipped(self) -> bool:
+        return self.duplicate_of is not None
+
+
+def read_log(path: Path, ingested: Ingested) -> tuple[dict[int, str], Iterator[dict[str, int | str]]]:
+    """Roles and talks of a tournament log, read one row at a time.
+
+    The roles are filled in from the status rows while the talks are iterated. The status
+    rows of day 0 come before any talk, so each talk's speaker is known by then.
+    """
+    roles: dict[int, str] = {}
+
+    def talks() -> Iterator[dict[str, int | str]]:
+        with open(path, mode="r", encoding="utf-8") as f:
+            for row in f:
+                row = row.rstrip("\r\n")
+                try:
+                    if row.startswith("0,status,"):
+                        fields = row.split(",", 5)
+                        roles.setdefault(int(fields[2]), fields[3])
+                        continue
+                    talk = parse_row(row)
+                except (ValueError, IndexError):
+                    ingested.rejected += 1
+                    continue
+                if talk is not None:
+                    yield talk
+
+    return roles, talks()
+
+
+def read_json(path: Path, ingested: Ingested) -> tuple[dict[int, str], Iterator[dict[str, int | str]]]:
+    """Talks of a log_to_json .json file or a converted .jsonl file. These have no roles."""
+    if path.suffix == ".json":
+        with open(path, encoding="utf-8") as f:
+            return {}, iter(json.load(f))
+
+    def talks() -> Iterator[dict[str, int | str]]:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    ingested.rejected += 1
+
+    return {}, talks()
+
+
+class Corpus:
+    """Talks of past games in SQLite, indexed by game/day/agent/role and searchable by text.
+
+    Text search uses an FTS5 table with the trigram tokenizer, which works for Japanese
+    without word segmentation. Seer COs are labelled at ingestion with the Matcher, so
+    queries about them are plain indexed joins.
+
+    Args:
+        path (str | Path): database file. ":memory:" keeps it in memory.
+    """
+
+    def __init__(self, path: str | Path = "data/corpus.sqlite") -> None:
+        self.connection = sqlite3.connect(str(path))
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        # 取り込む時だけ作る. 検索だけならエージェント側のモジュールを読み込まない
+        self.matcher = None
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def ingest(self, path: Path) -> Ingested:
+        """Add a game from a tournament log (.log), a log_to_json file (.json) or JSONL (.jsonl).
+
+        Games are identified by the hash of the file's content, so a file whose content is
+        already ingested is skipped whatever its name, and reported with the file it duplicates.
+        The game is named after the file stem. When another game already has that name, such
+        as the same log name from another tournament, the name gets the hash appended.
+        """
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        ingested = Ingested(path.stem)
+        if found := self.connection.execute("SELECT source FROM games WHERE digest = ?", (digest,)).fetchone():
+            ingested.duplicate_of = found["source"]
+            return ingested
+        if self.connection.execute("SELECT 1 FROM games WHERE name = ?", (ingested.game,)).fetchone():
+            ingested.game = f"{path.stem}-{digest[:12]}"
+            ingested.collided = True
+        roles, talks = read_log(path, ingested) if path.suffix == ".log" else read_json(path, ingested)
+        with self.connection:
+            game = self.connection.execute(
+                "INSERT INTO games (name, source, digest) VALUES (?, ?, ?)", (ingested.game, str(path), digest)
+            ).lastrowid
+            cos: dict[int, tuple] = {}
+            rows = []
+            start = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM talks").fetchone()[0] + 1
+            for talk in talks:
+                talk_id = start + len(rows)
+                agent = int(talk["agent"])
+                rows.append((talk_id, game, talk["day"], talk["turn"], talk["idx"], agent, roles.get(agent), talk["text"]))
+                if agent not in cos:
+                    co = self.seer_co(talk)
+                    if co is not None:
+                        cos[agent] = (talk_id, game, talk["day"], agent, *co)
+            self.connection.executemany("INSERT INTO talks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute(
+                "INSERT INTO talks_fts (rowid, text) SELECT id, text FROM talks WHERE game = ?", (game,)
+            )
+            self.connection.executemany("INSERT INTO seer_cos VALUES (?, ?, ?, ?, ?, ?)", cos.values())
+            ingested.talks = len(rows)
+        return ingested
+
+    def seer_co(self, talk: dict[str, int | str]) -> Optional[tuple[Optional[int], Optional[str]]]:
+        """(target, report) when the talk claims to be the seer, with None for a CO without a result."""
+        from src.agent.lib.matcher import UNSURE, Matcher
+
+        if self.matcher is None:
+            self.matcher = Matcher()
+        claims = self.matcher.resolve("seer", talk)
+        if claims:
+            return claims[0]["target"], claims[0]["report"]
+        if claims is None and SEER_CO.search(talk["text"]) and not UNSURE.search(talk["text"]):
+            return None, None
+        return None
+
+    def talks(
+        self,
+        game: Optional[str] = None,
+        day: Optional[int] = None,
+        agent: Optional[int] = None,
+        role: Optional[str] = None,
+        text: Optional[str] = None,
+        limit: Optional[int] = 100,
+    ) -> list[dict]:
+        """Talks matching every given filter, in the order they were spoken.
+
+        Args:
+            text (Optional[str], optional): substring of the talk. Full text search when it has
+                at least three characters. Defaults to None.
+        """
+        where, parameters = [], []
+        source = "talks t"
+        if text is not None and len(text) >= MIN_FTS_CHARS:
+            source = "talks_fts JOIN talks t ON t.id = talks_fts.rowid"
+            where.append("talks_fts MATCH ?")
+            parameters.append('"' + text.replace('"', '""') + '"')
+        elif text is not None:
+            where.append("t.text LIKE ? ESCAPE '\\'")
+            parameters.append("%" + re.sub(r"([%_\\])", r"\\\1", text) + "%")
+        for column, value in (("g.name", game), ("t.day", day), ("t.agent", agent), ("t.role", role)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                parameters.append(value)
+        query = (
+            f"SELECT g.name AS game, t.day, t.turn, t.idx, t.agent, t.role, t.text FROM {source}"
+            " JOIN games g ON g.id = t.game"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY t.id"
+            + (" LIMIT ?" if limit is not None else "")
+        )
+        if limit is not None:
+            parameters.append(limit)
+        return [dict(row) for row in self.connection.execute(query, parameters)]
+
+    def countered_seer_cos(self, day: int = 1, limit: Optional[int] = None) -> list[dict]:
+        """Seer COs made on the day that another agent of the same game countered afterwards."""
+        query = """
+            SELECT g.name AS game, c.day, t.turn, t.idx, c.agent, t.role, c.target, c.report, t.text,
+                   (SELECT d.agent FROM seer_cos d WHERE d.game = c.game AND d.talk > c.talk ORDER BY d.talk LIMIT 1) AS countered_by
+            FROM seer_cos c
+            JOIN talks t ON t.id = c.talk
+            JOIN games g ON g.id = c.game
+            WHERE c.day = ? AND EXISTS (SELECT 1 FROM seer_cos d WHERE d.game = c.game AND d.talk > c.talk)
+            ORDER BY c.talk
+        """ + (" LIMIT ?" if limit is not None else "")
+        parameters = (day, limit) if limit is not None else (day,)
+        return [dict(row) for row in self.connection.execute(query, parameters)]
+
+
+def paths(patterns: Iterable[str]) -> list[Path]:
+    return sorted({Path(path) for pattern in patterns for path in glob.glob(pattern)})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="過去大会の発話をSQLiteに蓄積して検索する")
+    parser.add_argument("--db", default="data/corpus.sqlite")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="ログ(.log), log_to_jsonの.json, 変換した.jsonlを取り込む")
+    ingest.add_argument("patterns", nargs="+", help='glob. 例: "data/*.log" data/sample.json')
+    query = commands.add_parser("query", help="条件に合う発話を表示する")
+    query.add_argument("--game")
+    query.add_argument("--day", type=int)
+    query.add_argument("--agent", type=int)
+    query.add_argument("--role")
+    query.add_argument("--text")
+    query.add_argument("--limit", type=int, default=20)
+    countered = commands.add_parser("countered", help="対抗COされた占いCOを表示する")
+    countered.add_argument("--day", type=int, default=1)
+    countered.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    corpus = Corpus(args.db)
+    start = time.perf_counter()
+    if args.command == "ingest":
+        games = talks = rejected = skipped = 0
+        for path in paths(args.patterns):
+            ingested = corpus.ingest(path)
+            if ingested.skipped and ingested.duplicate_of != str(path):
+                print(f"skipped {path}: same content as {ingested.duplicate_of}")
+            elif ingested.collided:
+                print(f"renamed {path} to {ingested.game}: another game is named {path.stem}")
+            games += not ingested.skipped
+            skipped += ingested.skipped
+            talks += ingested.talks
+            rejected += ingested.rejected
+        print(f"games: {games}, talks: {talks}, rejected rows: {rejected}, already ingested: {skipped}")
+    else:
+        if args.command == "query":
+            rows = corpus.talks(args.game, args.day, args.agent, args.role, args.text, args.limit)
+        else:
+            rows = corpus.countered_seer_cos(args.day, args.limit)
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+        print(f"{len(rows)} rows")
+    print(f"{time.perf_counter() - start:.3f}s")
+    corpus.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import glob
+import mmap
+import random
+import re
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional
+
+import numpy as np
+
+from src.models.lib.log_to_json import parse_row
+from src.models.lib.names import name
+
+KINDS = ("vote", "seer")
+# 文字n-gramを落とし込む次元. 1件あたり4 * DIMバイト
+DIM = 128
+NGRAMS = (2, 3)
+# 種類ごとに持つ例の上限. 検索は発話数 * 例の数 * DIMの積和なので, 1msに収まるよう抑える
+MAX_EXAMPLES = 5000
+# n-gramのハッシュ. プロセスによらず同じ値になるよう, 文字コードから計算する
+PRIME = np.uint64(1000003)
+MIX = np.uint64(0x9E3779B97F4A7C15)
+# 投票の宣言に使われる語. Matcherのキーワードに加えて「一票」などの言い回し
+VOTE_WORDS = ("投票", "票", "吊", "追放", "処刑")
+MENTION = re.compile(r"Agent\[0(\d)\]")
+SPECIES = {"HUMAN": "白", "WEREWOLF": "黒"}
+# 名前の後ろに書かれた占い結果の語
+RESULTS = {"人間": "白", "人狼": "黒", "白": "白", "黒": "黒"}
+RESULT = re.compile("|".join(RESULTS))
+# 名前の後ろのこの範囲に, 投票の語や結果の語が書かれているものだけを宣言とみなす
+WINDOW = 15
+# 否定や質問, 他人への呼びかけ. 名前の後ろに含む発話は答えが分からないので使わない
+NEGATION = re.compile(r"[?？]|ない|ません|せん|せず|するな|やめ|しよう|してほしい|して欲しい|ください")
+
+Talk = dict[str, str | int]
+
+
+def embed_many(texts: list[str], dim: int = DIM) -> np.ndarray:
+    """L2-normalized counts of the hashed character n-grams of each text, one row per text.
+
+    The texts are hashed together in a few numpy operations instead of a Python loop per
+    n-gram, so embedding the talks of an analysis stays well under a millisecond.
+    """
+    counts = np.zeros(len(texts) * dim, dtype=np.float32)
+    codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    rows = np.repeat(np.arange(len(texts)), [len(text) for text in texts])
+    for n in NGRAMS:
+        size = len(codes) - n + 1
+        if size <= 0:
+            continue
+        hashes = np.full(size, n, dtype=np.uint64)
+        for offset in range(n):
+            hashes = hashes * PRIME + codes[offset : offset + size]
+        buckets = ((hashes * MIX) >> np.uint64(32)) % np.uint64(dim)
+        # 2つの発話にまたがるn-gramは数えない
+        inside = rows[:size] == rows[n - 1 :]
+        counts += np.bincount(rows[:size][inside] * dim + buckets[inside].astype(np.int64), minlength=len(counts))
+    vectors = counts.reshape(len(texts), dim)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def embed(text: str, dim: int = DIM) -> np.ndarray:
+    return embed_many([text], dim)[0]
+
+
+def label(kind: str, result: dict[int, int] | list[dict[str, int | str]]) -> str:
+    """Expected output of the analysis prompt for a resolved talk."""
+    if kind == "vote":
+        lines = [f"{name(actor)} -> {name(target)}" for actor, target in result.items()]
+    else:
+        lines = [f"{name(claim['actor'])}, {name(claim['target'])}, {claim['report']}" for claim in result]
+    return "\n".join(lines) or "None"
+
+
+@dataclass
+class Game:
+    """What a tournament log says happened, used as the answer for its talks."""
+
+    talks: list[Talk] = field(default_factory=list)
+    roles: dict[int, str] = field(default_factory=dict)
+    votes: dict[tuple[int, int], int] = field(default_factory=dict)  # (日, 投票者) -> その日最初の投票先
+    divines: list[tuple[int, int, int, str]] = field(default_factory=list)  # (日, 占い師, 対象, HUMAN/WEREWOLF)
+
+
+def read_game(path: Path) -> Game:
+    """Talks, roles, votes and divinations of a tournament log. Malformed rows are skipped."""
+    game = Game()
+    with open(path, mode="r", encoding="utf-8") as f:
+        for row in f:
+            fields = row.rstrip("\r\n").split(",", 5)
+            try:
+                if fields[1] == "status" and fields[0] == "0":
+                    game.roles[int(fields[2])] = fields[3]
+                elif fields[1] == "vote":
+                    game.votes.setdefault((int(fields[0]), int(fields[2])), int(fields[3]))
+                elif fields[1] == "divine":
+                    game.divines.append((int(fields[0]), int(fields[2]), int(fields[3]), fields[4]))
+                elif (talk := parse_row(row.rstrip("\r\n"))) is not None:
+                    game.talks.append(talk)
+            except (ValueError, IndexError):
+                continue
+    return game
+
+
+def statements(text: str) -> list[tuple[int, str]]:
+    """(agent, what follows its name up to the next name or the end of the sentence) of each name."""
+    found = []
+    for match in MENTION.finditer(text):
+        rest = re.split(r"[。！!\n]|Agent\[", text[match.end() :], maxsplit=1)[0]
+        found.append((int(match.group(1)), rest[:WINDOW]))
+    return found
+
+
+def answer(kind: str, talk: Talk, game: Game) -> Optional[dict[int, int] | list[dict[str, int | str]]]:
+    """The answer the analysis should give for the talk, None when the talk is left out.
+
+    The answer is what the talk states: a vote word or a result word right after a name.
+    The log only confirms it. A talk whose statement disagrees with the speaker's actual
+    vote or the seer's actual result, a negated or asked statement, and a talk that talks
+    about votes or results without stating them are left out. Divinations talked about by
+    anyone but the real seer may be false claims the log does not record, so only a talk
+    without result words is used from them, as an example of no claim.
+    """
+    actor, text = int(talk["agent"]), str(talk["text"])
+    named = statements(text)
+    if kind == "vote":
+        if not any(word in text for word in VOTE_WORDS):
+            return {}
+        stated = {agent for agent, rest in named if any(word in rest for word in VOTE_WORDS)}
+        if len(stated) != 1 or any(NEGATION.search(rest) for _, rest in named):
+            return None
+        target = stated.pop()
+        voted = game.votes.get((int(talk["day"]), actor))
+        return {actor: target} if voted == target else None
+    if RESULT.search(text) is None:
+        return []
+    if game.roles.get(actor) != "SEER":
+        return None
+    divined = {target: SPECIES.get(species, "白") for day, seer, target, species in game.divines if seer == actor and day < int(talk["day"])}
+    claims = []
+    for agent, rest in named:
+        result = RESULT.search(rest)
+        if result is None or NEGATION.search(rest):
+            continue
+        claims.append({"actor": actor, "target": agent, "report": RESULTS[result.group()]})
+    # 名前ごとに結果が書かれていて, その全てが実際の占い結果と一致する時だけ使う
+    if not claims or len(claims) != len(named) or any(divined.get(claim["target"]) != claim["report"] for claim in claims):
+        return None
+    return claims
+
+
+def examples(kind: str, games: Iterable[Game], matcher: Any) -> Iterator[tuple[str, str]]:
+    """(input line, output) of the talks that the agent would send to the model.
+
+    Those are the talks the Matcher cannot resolve, so the examples resemble what the model
+    is actually asked about. Their outputs come from the votes and divinations in the log.
+    """
+    seen = set()
+    for game in games:
+        for talk in game.talks:
+            text = str(talk["text"])
+            if text in seen or matcher.resolve(kind, talk) is not None:
+                continue
+            result = answer(kind, talk, game)
+            if result is None:
+                continue
+            seen.add(text)
+            yield f"{name(talk['agent'])}: {text.replace(chr(9), ' ')}", label(kind, result)
+
+
+def build(directory: Path, kind: str, pairs: Iterable[tuple[str, str]], limit: int = MAX_EXAMPLES, seed: int = 0) -> int:
+    """Write the index of a kind: <kind>.npy vectors, <kind>.bin texts and <kind>.offsets.npy.
+
+    Returns:
+        int: number of examples written
+    """
+    # 多すぎる場合は一様にサンプルする
+    reservoir: list[tuple[str, str]] = []
+    rng = random.Random(seed)
+    for seen, pair in enumerate(pairs):
+        if len(reservoir) < limit:
+            reservoir.append(pair)
+        elif (slot := rng.randrange(seen + 1)) < limit:
+            reservoir[slot] = pair
+    directory.mkdir(parents=True, exist_ok=True)
+    vectors = np.zeros((len(reservoir), DIM), dtype=np.float32)
+    offsets = np.zeros(len(reservoir) + 1, dtype=np.int64)
+    with open(directory / f"{kind}.bin", "wb") as f:
+        for number, (line, output) in enumerate(reservoir):
+            data = f"{line}\t{output}".encode("utf-8")
+            f.write(data)
+            offsets[number + 1] = offsets[number] + len(data)
+    if reservoir:
+        vectors = embed_many([line.partition(": ")[2] for line, _ in reservoir])
+    np.save(directory / f"{kind}.npy", vectors)
+    np.save(directory / f"{kind}.offsets.npy", offsets)
+    return len(reservoir)
+
+
+class FewShot:
+    """k nearest past utterance/label pairs for the vote and seer analysis prompts.
+
+    The index is opened on first use, or by prepare() at startup. Vectors and offsets are
+    np.load(mmap_mode="r") and texts an mmap of the .bin file, so opening copies nothing and
+    worker processes share the pages through the OS page cache. Only the k chosen examples
+    are decoded.
+
+    Args:
+        directory (str | Path): directory written by build
+        k (int, optional): examples per prompt. Defaults to 4.
+    """
+
+    def __init__(self, directory: str | Path, k: int = 4) -> None:
+        self.directory = Path(directory)
+        self.k = k
+        self.indexes: dict[str, Optional[tuple[np.ndarray, np.ndarray, mmap.mmap]]] = {}
+        self.lock = threading.Lock()
+
+    def prepare(self) -> None:
+        for kind in KINDS:
+            self.index(kind)
+
+    def index(self, kind: str) -> Optional[tuple[np.ndarray, np.ndarray, mmap.mmap]]:
+        """(vectors, offsets, texts) of the kind, None when it has not been built."""
+        if kind not in self.indexes:
+            with self.lock:
+                if kind not in self.indexes:
+                    self.indexes[kind] = self.open(kind)
+        return self.indexes[kind]
+
+    def open(self, kind: str) -> Optional[tuple[np.ndarray, np.ndarray, mmap.mmap]]:
+        vectors_file = self.directory / f"{kind}.npy"
+        if not vectors_file.exists():
+            return None
+        vectors = np.load(vectors_file, mmap_mode="r")
+        offsets = np.load(self.directory / f"{kind}.offsets.npy", mmap_mode="r")
+        with open(self.directory / f"{kind}.bin", "rb") as f:
+            texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else None
+        return vectors, offsets, texts
+
+    def search(self, kind: str, talks: list[Talk], k: Optional[int] = None) -> list[tuple[str, str]]:
+        """(input line, output) of the examples closest to any of the talks, most similar first."""
+        index = self.index(kind)
+        k = self.k if k is None else k
+        if index is None or not talks or not k or len(index[0]) == 0:
+            return []
+        vectors, offsets, texts = index
+        queries = embed_many([str(talk["text"]) for talk in talks])
+        # 各例について最も近い発話との類似度. 行列の向きは例を連続に読む方が速い
+        scores = np.ascontiguousarray((vectors @ queries.T).T).max(axis=0)
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        pairs = []
+        for number in best:
+            line, _, output = texts[offsets[number] : offsets[number + 1]].decode("utf-8").partition("\t")
+            pairs.append((line, output))
+        return pairs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="投票先/占い結果の解析に使う例の索引を作る")
+    parser.add_argument("--logs", default="data/*.log", help="過去大会のログのglob. 投票と占いの行を答えに使う")
+    parser.add_argument("--output", default="data/fewshot")
+    parser.add_argument("--limit", type=int, default=MAX_EXAMPLES, help="種類ごとの例の上限")
+    args = parser.parse_args()
+
+    # 索引を作る時だけ使う. エージェントが読み込む時にはagent側に依存しない
+    from src.agent.lib.matcher import Matcher
+
+    matcher = Matcher()
+    paths = sorted(map(Path, glob.glob(args.logs)))
+    for kind in KINDS:
+        games = (read_game(path) for path in paths)
+        count = build(Path(args.output), kind, examples(kind, games, matcher), args.limit)
+        print(f"{kind}: {count} examples")
+
+
+if __name__ == "__main__":
+    main()
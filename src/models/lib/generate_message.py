@@ -1,14 +1,35 @@
 from typing import Optional, Union
 
+from src.models.lib.history import ChatHistory
 from src.models.lib.prompt import *
+from src.models.lib.tokens import count_tokens
 from src.models.lib.utils import get_until_today_history
 
 
+def render_history(
+    chat_history: list[dict[str, Union[str, int]]] | ChatHistory, budget: Optional[int]
+) -> str:
+    """Chat history that fits in budget tokens, dropping the oldest talks first."""
+    if budget is None:
+        return get_until_today_history(chat_history)
+    if not isinstance(chat_history, ChatHistory):
+        chat_history = ChatHistory(chat_history)
+    return chat_history.render(max(budget, 0))
+
+
 def make_messages(
     system_call: dict[str, str],
     chat_history: Optional[list[dict[str, Union[str, int]]]],
     towards_me: list[dict[str, str]] = [],
+    budget: Optional[int] = None,
 ) -> tuple[str, str]:
+    """Build the system and user prompts.
+
+    Args:
+        budget (Optional[int], optional): tokens the prompts may use in total. The chat
+            history gets what is left after the other parts. None puts the whole history.
+            Defaults to None.
+    """
     content_message: str = ""
     request: str = system_call.get("request")
     behavior: str = system_call.get("behavior")
@@ -30,11 +51,13 @@ def make_messages(
         content_message += MY_NUMBER.format(idx)
     elif request == "vote" or request == "divine" or request == "attack":
         content_message += MY_NUMBER.format(idx)
+        suffix = TARGET.format(target)
         if chat_history:
-            content_message += CHAT_HISTORY_START + get_until_today_history(
-                chat_history
+            content_message += CHAT_HISTORY_START
+            content_message += render_history(
+                chat_history, rest(budget, content_message, suffix, ACTION.get(request, ""))
             )
-        content_message += TARGET.format(target)
+        content_message += suffix
     else:
         content_message += (
             GENERAL + RULE.format(PERSONA=map_to_personas[idx])+ YOURSELF.format(idx) + ALIVE.format(alive)
@@ -49,19 +72,60 @@ def make_messages(
         }.get(behavior, "")
         content_message += UNDERSTAND + OUTPUT
 
-        if chat_history:
-            content_message += (
-                CHAT_HISTORY_START
-                + INPUT
-                + get_until_today_history(chat_history)
-                + PREDICT_OUTPUT_SYMBOL.format(idx)
-            )
-
+        suffix = ""
         if towards_me:
             towards_content = towards_me[0]
-            content_message += TOWARDS_ME.format(
+            suffix = TOWARDS_ME.format(
                 towards_content["from"], towards_content["text"]
             )
 
+        if chat_history:
+            content_message += CHAT_HISTORY_START + INPUT
+            symbol = PREDICT_OUTPUT_SYMBOL.format(idx)
+            content_message += (
+                render_history(
+                    chat_history, rest(budget, content_message, symbol, suffix, ACTION.get(request, ""))
+                )
+                + symbol
+            )
+
+        content_message += suffix
+
     # gptの場合, role:systemにcontent_message, role:userにACTION.get(request, "")を返す
     return content_message, ACTION.get(request, "")
+
+
+def rest(budget: Optional[int], *parts: str) -> Optional[int]:
+    """Tokens left for the chat history after the fixed parts of the prompt.
+
+    The parts take only a few values in a game (the system prompt changes with the alive and
+    dead agents), so their counts are memoized instead of tokenizing them on every call.
+    """
+    if budget is None:
+        return None
+    return budget - sum(count_tokens(part) for part in parts)
+
+
+def make_declare_messages(
+    kind: str, talks: list[str], idx: int, known: str = "", examples: list[tuple[str, str]] = ()
+) -> tuple[str, str]:
+    """Build the system and user prompts of the vote ("vote") or seer ("seer") analysis.
+
+    Args:
+        talks (list[str]): formatted talks to analyse
+        known (str, optional): what earlier analyses found. Defaults to "".
+        examples (list[tuple[str, str]], optional): (input, output) pairs retrieved from past
+            games that replace the fixed examples. Defaults to ().
+    """
+    if kind == "vote":
+        task, fixed, practice, known_prompt, user_prompt = (
+            VOTE_DECLARE_TASK, VOTE_DECLARE_EXAMPLES, VOTE_DECLARE_PRACTICE, KNOWN_VOTE_DECLARE, USER_VOTE_DECLARE
+        )
+    else:
+        task, fixed, practice, known_prompt, user_prompt = (
+            SEER_DECLARE_TASK, SEER_DECLARE_EXAMPLES, SEER_DECLARE_PRACTICE, KNOWN_SEER_DECLARE, USER_SEER_DECLARE
+        )
+    if examples:
+        fixed = "".join(FEW_SHOT_EXAMPLE.format(number, line, output) for number, (line, output) in enumerate(examples, start=1))
+    system_prompt = task + fixed + practice.format("".join(talks), str(idx))
+    return system_prompt, (known_prompt.format(known) if known else "") + user_prompt
@@ -0,0 +1,166 @@
+import threading
+from typing import Iterable, Iterator, Optional
+
+from src.models.lib.names import name
+from src.models.lib.tokens import count_tokens
+
+
+def format_talk(talk: dict[str, str | int]) -> str:
+    return f"{name(talk['agent'])}: {talk['text']}\n"
+
+
+def heading(day: int) -> str:
+    return f"### {day}日目\n"
+
+
+class ChatHistory:
+    """Chat history with the prompt text rendered as it grows.
+
+    Lines (day headings and talks) are kept in one append-only list, and the rendered text
+    grows by the new line on each append. A copy shares the list and remembers how many
+    lines it sees, so copying is O(days) however long the history is. Only discard()
+    rebuilds, into a new list that the copies do not see. Token counts of each line are
+    kept too, so rendering within a budget only counts the new lines.
+    """
+
+    def __init__(self, talks: Iterable[dict[str, str | int]] = ()) -> None:
+        self.talks: list[Optional[dict[str, str | int]]] = []  # 見出しの行はNone
+        self.lines: list[str] = []
+        self.starts: dict[int, int] = {}  # 日 -> 見出しの行の位置
+        self.tokens: list[int] = []  # 各行のトークン数. 予算つきのrenderで必要になった分だけ数える
+        self.lock = threading.Lock()
+        self.text = ""
+        self.count = 0  # このChatHistoryから見える行の数
+        self.size = 0
+        for talk in talks:
+            self.append(talk)
+
+    def add_line(self, talk: Optional[dict[str, str | int]], line: str) -> None:
+        # コピーと共有しているリストの, このChatHistoryから見えない部分は捨てて書き足す
+        if len(self.lines) > self.count:
+            self.talks, self.lines = self.talks[: self.count], self.lines[: self.count]
+            self.tokens, self.lock = self.tokens[: self.count], threading.Lock()
+        self.talks.append(talk)
+        self.lines.append(line)
+        self.text += line
+        self.count += 1
+
+    def append(self, talk: dict[str, str | int]) -> None:
+        day = talk["day"]
+        if self.starts and day < max(self.starts):
+            # 前の日の発話が後から来た時だけ, 日の順に並べ直す
+            self.rebuild(sorted([*self, talk], key=lambda item: item["day"]))
+            return
+        if day not in self.starts:
+            self.starts[day] = self.count
+            self.add_line(None, heading(day))
+        self.add_line(talk, format_talk(talk))
+        self.size += 1
+
+    def extend(self, talks: Iterable[dict[str, str | int]]) -> None:
+        for talk in talks:
+            self.append(talk)
+
+    def rebuild(self, talks: list[dict[str, str | int]]) -> None:
+        """Start over from the talks into new lists, leaving the ones shared with copies as they are."""
+        self.talks, self.lines, self.starts, self.tokens = [], [], {}, []
+        self.lock = threading.Lock()
+        self.text, self.count, self.size = "", 0, 0
+        for talk in talks:
+            self.append(talk)
+
+    def discard(self, texts: set[str], day: int) -> None:
+        """Remove the talks of the given day whose text is in texts.
+
+        Args:
+            texts (set[str]): texts to remove such as Skip and Over
+            day (int): day to filter. Earlier days are assumed to be filtered already.
+        """
+        if not any(talk["text"] in texts for talk in self.day(day)):
+            return
+        self.rebuild([talk for talk in self if talk["day"] != day or talk["text"] not in texts])
+
+    def day_range(self, day: int) -> tuple[int, int]:
+        """Positions of the heading and the end of the lines of the day."""
+        start = self.starts[day]
+        later = [position for position in self.starts.values() if position > start]
+        return start, min(later, default=self.count)
+
+    def day(self, day: int) -> list[dict[str, str | int]]:
+        if day not in self.starts:
+            return []
+        start, end = self.day_range(day)
+        return self.talks[start + 1 : end]
+
+    def line_tokens(self) -> list[int]:
+        """Token counts of the lines, counting only the lines added since the last call."""
+        with self.lock:
+            # 共有しているリストの先頭は, どのコピーから見ても同じ行
+            if len(self.tokens) < self.count:
+                self.tokens.extend(count_tokens(line) for line in self.lines[len(self.tokens) : self.count])
+            return self.tokens[: self.count]
+
+    def count_tokens(self) -> int:
+        return sum(self.line_tokens())
+
+    def render(self, budget: Optional[int] = None) -> str:
+        """Render the history for each day with the same format as get_until_today_history.
+
+        Args:
+            budget (Optional[int], optional): maximum number of tokens. The oldest talks are
+                dropped first, and a day keeps its heading while any of its talks remain.
+                None renders everything. Defaults to None.
+        """
+        if budget is None:
+            return self.text
+        counts = self.line_tokens()
+        if sum(counts) <= budget:
+            return self.text
+        texts = []
+        for day in sorted(self.starts, reverse=True):
+            start, end = self.day_range(day)
+            total = sum(counts[start:end])
+            if total <= budget:
+                texts.append("".join(self.lines[start:end]))
+                budget -= total
+                continue
+            # 入り切らない日は見出しと新しい発話だけを残し, それより前の日は捨てる
+            budget -= counts[start]
+            kept = end
+            while kept > start + 1 and counts[kept - 1] <= budget:
+                budget -= counts[kept - 1]
+                kept -= 1
+            if kept < end:
+                texts.append(self.lines[start] + "".join(self.lines[kept:end]))
+            break
+        return "".join(reversed(texts))
+
+    def copy(self) -> "ChatHistory":
+        """Copy that can be read by another thread while this one keeps growing.
+
+        The lists are shared. This history only appends to them, and the copy reads the
+        first count lines, which do not change.
+        """
+        history = ChatHistory.__new__(ChatHistory)
+        history.talks, history.lines, history.tokens, history.lock = self.talks, self.lines, self.tokens, self.lock
+        history.starts = dict(self.starts)
+        history.text, history.count, history.size = self.text, self.count, self.size
+        return history
+
+    def __getstate__(self) -> dict:
+        # ワーカープロセスへは見える行だけを送る. ロックは送れないので向こうで作る
+        state = dict(self.__dict__, talks=self.talks[: self.count], lines=self.lines[: self.count], tokens=self.tokens[: self.count])
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[dict[str, str | int]]:
+        for talk in self.talks[: self.count]:
+            if talk is not None:
+                yield talk
+
+    def __len__(self) -> int:
+        return self.size
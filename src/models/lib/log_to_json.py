@@ -1,6 +1,89 @@
+import argparse
+import glob
 import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator, Optional
+
+# ログの先頭のステータス行と末尾の結果行の数. この間だけを読む
+HEAD = 5
+TAIL = 8
+# Parquetの行グループの行数の下限と上限. 小さいゲームをまとめて大きな行グループにする
+MIN_ROWS_PER_GROUP = 100000
+MAX_ROWS_PER_GROUP = 1000000
+COLUMNS = ("game", "day", "turn", "agent", "idx", "text")
+
+
+@dataclass
+class Rejected:
+    """A row in the talk window that could not be parsed."""
+
+    game: str
+    line: int
+    row: str
+    reason: str
+
+
+@dataclass
+class Conversion:
+    """Result of converting one log file."""
+
+    game: str
+    talks: int = 0
+    skipped: int = 0  # 発話以外の行(投票, 占いなど)
+    rejected: list[Rejected] = field(default_factory=list)
+
+
+def window(lines: Iterable[str], head: int = HEAD, tail: int = TAIL) -> Iterator[tuple[int, str]]:
+    """(line number, row) of lines[head:-tail] without reading the whole file."""
+    buffer: deque[tuple[int, str]] = deque()
+    for number, line in enumerate(lines, start=1):
+        if number <= head:
+            continue
+        buffer.append((number, line.rstrip("\r\n")))
+        if len(buffer) > tail:
+            yield buffer.popleft()
+
+
+def parse_row(row: str) -> Optional[dict[str, int | str]]:
+    """Talk of a "day,talk,idx,turn,agent,text" row, None for rows of other kinds.
+
+    Raises:
+        ValueError: when the row is a talk but malformed
+    """
+    # 発話にカンマが含まれていても切らない
+    fields = row.split(",", 5)
+    if len(fields) < 2:
+        raise ValueError("too few fields")
+    if fields[1] != "talk":
+        return None
+    if len(fields) != 6:
+        raise ValueError(f"expected 6 fields, got {len(fields)}")
+    return {
+        "agent": int(fields[4]),
+        "day": int(fields[0]),
+        "idx": int(fields[2]),
+        "text": fields[5],
+        "turn": int(fields[3]),
+    }
+
+
+def iter_talks(log_file: Path, conversion: Conversion) -> Iterator[dict[str, int | str]]:
+    """Talks of a log file, one row at a time. Other rows are counted in conversion."""
+    with open(log_file, mode="r", encoding="utf-8") as f:
+        for number, row in window(f):
+            try:
+                talk = parse_row(row)
+            except ValueError as e:
+                conversion.rejected.append(Rejected(conversion.game, number, row, str(e)))
+                continue
+            if talk is None:
+                conversion.skipped += 1
+                continue
+            conversion.talks += 1
+            yield talk
 
 
 def log_to_json(log_file: Path, remove_log: bool = False) -> list[dict[str, int | str]]:
@@ -15,24 +98,7 @@ def log_to_json(log_file: Path, remove_log: bool = False) -> list[dict[str, int
     Returns:
         list[dict[str, int | str]]: List of dict
     """
-    with open(log_file, mode="r") as f:
-        log_lines = [line.rstrip("\r\n") for line in f.readlines()]
-    output_dictlist = []
-    for row in log_lines[5:-8]:
-        fields = row.split(",")
-        if len(fields) == 6:
-            try:
-                output_dictlist.append(
-                    {
-                        "agent": int(fields[4]),
-                        "day": int(fields[0]),
-                        "idx": int(fields[2]),
-                        "text": fields[5],
-                        "turn": int(fields[3]),
-                    }
-                )
-            except:
-                pass
+    output_dictlist = list(iter_talks(log_file, Conversion(log_file.stem)))
 
     json_file = log_file.with_suffix(".json")
     with open(json_file, mode="w") as f:
@@ -42,7 +108,109 @@ def log_to_json(log_file: Path, remove_log: bool = False) -> list[dict[str, int
     return output_dictlist
 
 
+def parquet_schema() -> Any:
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("game", pa.string()),
+            ("day", pa.int32()),
+            ("turn", pa.int32()),
+            ("agent", pa.int32()),
+            ("idx", pa.int32()),
+            ("text", pa.string()),
+        ]
+    )
+
+
+def convert(log_file: Path, output_dir: Path, remove_log: bool = False) -> Conversion:
+    """Stream a log file into output_dir/jsonl/<game>.jsonl
+
+    Memory does not grow with the log: talks are written as they are read. The game id is
+    the stem of the file name.
+    """
+    conversion = Conversion(log_file.stem)
+    jsonl_file = output_dir / "jsonl" / f"{conversion.game}.jsonl"
+    jsonl_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(jsonl_file, mode="w", encoding="utf-8") as f:
+        for talk in iter_talks(log_file, conversion):
+            f.write(json.dumps({"game": conversion.game, **talk}, ensure_ascii=False, separators=(",", ":")) + "\n")
+    if remove_log:
+        log_file.unlink()
+    return conversion
+
+
+def write_parquet(jsonl_files: list[Path], output_dir: Path) -> None:
+    """Write the JSONL files as one Parquet dataset in output_dir/parquet, partitioned by day.
+
+    The games are streamed into a single dataset writer that fills row groups across games,
+    so the row groups are large however small each game is, and the schema is stated once.
+    """
+    import pyarrow.dataset as ds
+    import pyarrow.json as pj
+
+    schema = parquet_schema()
+    options = pj.ParseOptions(explicit_schema=schema)
+
+    def batches() -> Iterator[Any]:
+        # データセットとしてJSONを読ませるとCPUが1つの環境で止まるので, ファイルごとに読む
+        for path in jsonl_files:
+            yield from pj.read_json(path, parse_options=options).to_batches()
+
+    ds.write_dataset(
+        batches(),
+        output_dir / "parquet",
+        schema=schema,
+        format="parquet",
+        partitioning=["day"],
+        partitioning_flavor="hive",
+        min_rows_per_group=MIN_ROWS_PER_GROUP,
+        max_rows_per_group=MAX_ROWS_PER_GROUP,
+        existing_data_behavior="delete_matching",
+    )
+
+
+def convert_all(
+    log_files: Iterable[Path],
+    output_dir: Path,
+    workers: Optional[int] = None,
+    remove_log: bool = False,
+) -> Iterator[Conversion]:
+    """Convert the log files in parallel, one file per task, yielding the results in order."""
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(convert, log_file, output_dir, remove_log) for log_file in log_files]
+        for future in futures:
+            yield future.result()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="過去大会のログをJSONLとParquetに変換する")
+    parser.add_argument("--logs", default="data/*.log", help="変換するログのglob")
+    parser.add_argument("--output", default="data/talks", help="jsonl/, parquet/day=<日>/, rejected.jsonlを書き出すディレクトリ")
+    parser.add_argument("--workers", type=int, default=None, help="プロセス数. 既定はCPUの数")
+    parser.add_argument("--no-parquet", action="store_true", help="JSONLだけを書き出す")
+    parser.add_argument("--remove-log", action="store_true", help="変換したログを消す")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    games = talks = skipped = rejected = 0
+    jsonl_files = []
+    # 読めなかった行は捨てずに書き出す
+    with open(output_dir / "rejected.jsonl", mode="w", encoding="utf-8") as f:
+        for conversion in convert_all(sorted(map(Path, glob.glob(args.logs))), output_dir, args.workers, args.remove_log):
+            jsonl_files.append(output_dir / "jsonl" / f"{conversion.game}.jsonl")
+            games += 1
+            talks += conversion.talks
+            skipped += conversion.skipped
+            rejected += len(conversion.rejected)
+            for row in conversion.rejected:
+                f.write(json.dumps(asdict(row), ensure_ascii=False) + "\n")
+    # 全ゲームの変換が終わってから1つのデータセットにまとめる
+    if not args.no_parquet and jsonl_files:
+        write_parquet(jsonl_files, output_dir)
+    print(f"games: {games}, talks: {talks}, other rows: {skipped}, rejected rows: {rejected}")
+
+
 if __name__ == "__main__":
-    log_filelist: list[Path] = Path("data").glob("*.log")
-    for log_file in log_filelist:
-        _ = log_to_json(log_file)
+    main()
@@ -0,0 +1,13 @@
+# AIWolfの村は最大でも15人. 表示名は全員分を先に作っておく
+MAX_AGENTS = 15
+NAMES: tuple[str, ...] = tuple(f"Agent[{idx:02d}]" for idx in range(MAX_AGENTS + 1))
+
+
+def name(idx: int | str) -> str:
+    """Display name of an agent number, e.g. "Agent[03]"."""
+    return NAMES[int(idx)]
+
+
+def mention(idx: int | str) -> str:
+    """Prefix of a talk addressed to the agent, e.g. ">>Agent[03]"."""
+    return ">>" + NAMES[int(idx)]
@@ -0,0 +1,87 @@
+import re
+from typing import Optional
+
+# 1文字単位の置き換え. Noneは削除
+CHARS: dict[str, Optional[str]] = {
+    "「": None,
+    "」": None,
+    "；": None,
+    ";": None,
+    ":": None,
+    "：": None,
+    "’": None,
+    "'": None,
+    "　": None,  # 全角スペース
+    "(": None,
+    ")": None,
+    "♪": None,
+    ".": "。",
+}
+# 文字の置き換えの後に適用する語の置き換え
+WORDS: dict[str, str] = {
+    "XXX": "",
+}
+# キャラクターごとに追加する語の置き換え. 既定では何もしない.
+# 引用や複合語も置き換わるので, 使う場合はadd_personaで明示的に追加する. 例: add_persona("Agent[02]", {"私": "ワシ"})
+PERSONA_WORDS: dict[str, dict[str, str]] = {}
+
+AGENT_PREFIX = re.compile(r"Agent\[0\d\]: ")
+NON_DIGIT = re.compile(r"\D")
+
+
+class Normalizer:
+    """Normalizes generated text with one str.translate and one compiled alternation.
+
+    Args:
+        chars (dict[str, Optional[str]]): single characters to replace. None deletes the character.
+        words (dict[str, str]): strings replaced after chars. Longer strings win on overlap.
+    """
+
+    def __init__(self, chars: dict[str, Optional[str]], words: dict[str, str]) -> None:
+        self.chars = dict(chars)
+        self.words = dict(words)
+        self.table = str.maketrans(self.chars)
+        self.pattern = (
+            re.compile("|".join(re.escape(word) for word in sorted(self.words, key=len, reverse=True)))
+            if self.words
+            else None
+        )
+
+    def extend(
+        self, chars: Optional[dict[str, Optional[str]]] = None, words: Optional[dict[str, str]] = None
+    ) -> "Normalizer":
+        """New normalizer with extra rules added to (or overriding) these."""
+        return Normalizer({**self.chars, **(chars or {})}, {**self.words, **(words or {})})
+
+    def __call__(self, text: str) -> str:
+        text = text.translate(self.table)
+        # 置き換える語を含まない発話がほとんどなので, 先に探してから置き換える
+        if self.pattern is not None and self.pattern.search(text):
+            text = self.pattern.sub(self.replace, text)
+        return text
+
+    def replace(self, match: re.Match) -> str:
+        return self.words[match.group()]
+
+
+DEFAULT = Normalizer(CHARS, WORDS)
+_personas = {idx: DEFAULT.extend(words=words) for idx, words in PERSONA_WORDS.items()}
+
+
+def for_persona(idx: Optional[str]) -> Normalizer:
+    """Normalizer with the rules of the character played as idx such as "Agent[02]"."""
+    return _personas.get(idx, DEFAULT)
+
+
+def add_persona(idx: str, words: dict[str, str]) -> None:
+    """Opt in to word rules for the character played as idx, on top of the ones it already has."""
+    _personas[idx] = for_persona(idx).extend(words=words)
+
+
+def clean_talk(text: str, idx: Optional[str] = None) -> str:
+    """Post-process a generated talk: drop the newlines and the "Agent[0X]: " prefix, then normalize."""
+    return for_persona(idx)(AGENT_PREFIX.sub("", text.replace("\n", "")))
+
+
+def digits(text: str) -> str:
+    return NON_DIGIT.sub("", text)
@@ -75,13 +75,15 @@ CHAT_HISTORY_END = "\n以上が会話履歴です。\n"
 
 USER_PROMPT_END = "markdownは使用せず、1文での文章を出力してください。"
 
-SYSTEM_VOTE_DECLARE = """
+VOTE_DECLARE_TASK = """
 ## するべきこと
 入力として与えられる会話履歴の中から投票に関わる発話を探し、投票しようとしている人物と投票対象になっている人物を出力のようにまとめなさい。
 投票に関わる発話が見つからない場合は「None」と出力すること。複数存在する場合は出力も複数行にすること。
 また、出力にマークダウンは用いないでください。
 
-## 例1
+"""
+
+VOTE_DECLARE_EXAMPLES = """## 例1
 ### 入力
 Agent[04]: 私はAgent[06]に投票するつもりだ。
 ### 出力
@@ -107,21 +109,44 @@ Agent[05]: Agent[04]は村人だと思います。今日の投票はAgent[03]に
 Agent[01] -> Agent[04]
 Agent[05] -> Agent[03]
 
-## 実践
+"""
+
+VOTE_DECLARE_PRACTICE = """## 実践
 ### 入力{}Agent[06]: 私はAgent[0{}]に投票するつもりだ。
 ### 出力
 
 """
 
+SYSTEM_VOTE_DECLARE = VOTE_DECLARE_TASK + VOTE_DECLARE_EXAMPLES + VOTE_DECLARE_PRACTICE
+
+# 過去の発話から選んだ例. 固定の例の代わりに入れる
+FEW_SHOT_EXAMPLE = """## 例{}
+### 入力
+{}
+### 出力
+{}
+
+"""
+
 USER_VOTE_DECLARE ="例を参考にしながら実践の出力を続けてください。"
 
-SYSTEM_SEER_DECLARE = """
+# 前回までの分析結果. 入力は前回の分析より後の発話だけになる
+KNOWN_VOTE_DECLARE = """## これまでに分かっている投票先
+{}
+
+入力は前回の分析より後の発話だけです。これまでに分かっている投票先を踏まえ、入力から分かる投票先を出力してください。
+
+"""
+
+SEER_DECLARE_TASK = """
 ## するべきこと
 入力として与えられる会話履歴の中から占いに関わる発話を探し、占い師と占いの対象となった人物及びその結果を出力のようにまとめなさい。占い結果は人狼ならば黒、それ以外なら白と出力すること。
 占いに関わる発話が見つからない場合は「None」と出力すること。複数存在する場合は出力も複数行にすること。
 また、出力にマークダウンは用いないでください。
 
-## 例1
+"""
+
+SEER_DECLARE_EXAMPLES = """## 例1
 ### 入力
 Agent[01]: 私は占い師です。占いの結果、Agent[05]は人狼でした。
 ### 出力
@@ -150,14 +175,25 @@ Agent[05]: 特に変わった行動を取った人がいない以上、信じる
 Agent[01], Agent[04], 黒
 Agemt[02], Agent[01], 白
 
-## 実践
+"""
+
+SEER_DECLARE_PRACTICE = """## 実践
 ### 入力{}Agent[06]: 私は占い師です。占いの結果、Agent[0{}]は人間でした。
 ### 出力
 
 """
 
+SYSTEM_SEER_DECLARE = SEER_DECLARE_TASK + SEER_DECLARE_EXAMPLES + SEER_DECLARE_PRACTICE
+
 USER_SEER_DECLARE = "例を参考にしながら実践の出力を続けてください。"
 
+KNOWN_SEER_DECLARE = """## これまでに分かっている占い結果
+{}
+
+入力は前回の分析より後の発話だけです。これまでに分かっている占い結果を踏まえ、入力から分かる占い結果を出力してください。
+
+"""
+
 TOWARDS_ME = """
 ## あなたへの言及
 Agent[0{}]が、あなたに向けて「{}」と話しています。
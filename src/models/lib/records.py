@@ -0,0 +1,163 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Optional
+
+from src.models.lib import tracing
+
+# 1000トークンあたりの料金(入力, 出力). 無いモデルは0
+PRICES: dict[str, tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gemini-pro": (0.0, 0.0),
+}
+
+_logger = logging.getLogger("aiwolf.records")
+_logger.propagate = False
+_listener: Optional[logging.handlers.QueueListener] = None
+_pid: Optional[int] = None
+_lock = threading.Lock()
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Puts the record on the queue as it is. The stock handler formats it in the caller's thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record. Runs in the listener thread, so token counting happens here."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = dict(record.msg)
+        if fields.get("event") == "model_call":
+            fields = model_call_fields(fields)
+        return json.dumps({"time": round(record.created, 3), "pid": record.process, **fields}, ensure_ascii=False, default=str)
+
+
+def prompt_texts(prompt: Any) -> list[str]:
+    """Texts of OpenAI messages, Gemini contents or a plain string."""
+    if isinstance(prompt, str):
+        return [prompt]
+    if isinstance(prompt, dict):
+        prompt = [prompt]
+    texts = []
+    for message in prompt or []:
+        if "content" in message:
+            texts.append(str(message["content"]))
+        else:
+            parts = message.get("parts", [])
+            for part in parts if isinstance(parts, list) else [parts]:
+                texts.append(str(part.get("text", "")))
+    return texts
+
+
+def model_call_fields(fields: dict[str, Any]) -> dict[str, Any]:
+    """Replace the prompt with token counts and add the cost.
+
+    Counts reported by the API are used as they are. Otherwise the prompt and the output
+    are counted with the bundled tokenizer.
+    """
+    from src.models.lib.tokens import count_text
+
+    usage = fields.pop("usage", None) or {}
+    prompt = fields.pop("prompt", None)
+    input_tokens = usage.get("prompt_tokens", usage.get("promptTokenCount"))
+    output_tokens = usage.get("completion_tokens", usage.get("candidatesTokenCount"))
+    if input_tokens is None:
+        input_tokens = sum(count_text(text) for text in prompt_texts(prompt))
+    if output_tokens is None:
+        output_tokens = count_text(str(fields.get("output", "")))
+    input_price, output_price = PRICES.get(fields.get("model"), (0.0, 0.0))
+    return {
+        **fields,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost": round((input_tokens * input_price + output_tokens * output_price) / 1000, 8),
+    }
+
+
+def _rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def configure(
+    path: str = "logs/records.jsonl",
+    max_bytes: int = 10 * 1024 * 1024,
+    backups: int = 10,
+    compress: bool = True,
+    console: bool = False,
+) -> None:
+    """Start writing records from a background thread. Records are dropped until this is called.
+
+    Args:
+        path (str, optional): output file. Each process writes path with its pid such as
+            "logs/records-1234.jsonl". Defaults to "logs/records.jsonl".
+        max_bytes (int, optional): size at which the file is rotated. 0 never rotates.
+            Defaults to 10 MiB.
+        backups (int, optional): rotated files to keep. Defaults to 10.
+        compress (bool, optional): gzip rotated files. Defaults to True.
+        console (bool, optional): also write the records to stdout. Defaults to False.
+    """
+    global _listener, _pid
+    with _lock:
+        # fork先では親のスレッドが無いので作り直す
+        if _listener is not None and _pid == os.getpid():
+            return
+        file = Path(path)
+        file = file.with_name(f"{file.stem}-{os.getpid()}{file.suffix}")
+        file.parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        if compress:
+            handler.namer = lambda name: name + ".gz"
+            handler.rotator = _rotator
+        handlers: list[logging.Handler] = [handler]
+        if console:
+            handlers.append(logging.StreamHandler(sys.stdout))
+        for target in handlers:
+            target.setFormatter(JsonFormatter())
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        for old in list(_logger.handlers):
+            _logger.removeHandler(old)
+        _logger.addHandler(_QueueHandler(records))
+        _logger.setLevel(logging.INFO)
+        _listener = logging.handlers.QueueListener(records, *handlers)
+        _listener.start()
+        _pid = os.getpid()
+    atexit.register(shutdown)
+
+
+def shutdown() -> None:
+    """Write out the queued records and stop the thread."""
+    global _listener
+    with _lock:
+        if _listener is not None and _pid == os.getpid():
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+        _listener = None
+
+
+def record(event: str, **fields: Any) -> None:
+    """Queue a record with the tracing context (game, day, agent, request). Never blocks."""
+    if _listener is None or _pid != os.getpid():
+        return
+    _logger.info({"event": event, **tracing.context(), **fields})
+
+
+def model_call(model: str, request: str, latency: float, output: Any, prompt: Any = None, usage: Optional[dict] = None, cached: bool = False) -> None:
+    """Record a model call. prompt is counted in the background when usage is not given."""
+    record("model_call", model=model, model_request=request, latency=round(latency, 4), output=output, prompt=prompt, usage=usage, cached=cached)
+
@@ -0,0 +1,94 @@
+import re
+from dataclasses import dataclass
+from typing import Callable, Iterable, Optional
+
+from src.models.lib.normalize import AGENT_PREFIX, CHARS, WORDS
+
+# 発話の長さの目安. 短すぎる発話は内容がなく, 長すぎる発話は途中で切られる
+MIN_CHARS = 10
+MAX_CHARS = 125
+# normalize_textで消される文字や語. 含む候補は口調や書式が崩れていることが多い
+FORBIDDEN_CHARS = str.maketrans(dict.fromkeys(char for char in CHARS if char != "."))
+FORBIDDEN_WORDS = tuple(WORDS)
+# キャラクターごとの口調の目印. 含む候補ほど口調を保っている
+PERSONA_MARKERS: dict[str, tuple[str, ...]] = {
+    "Agent[01]": ("アーニャ", "ます", "わくわく"),
+    "Agent[02]": ("ワシ", "じゃ", "やで", "けぇ"),
+    "Agent[03]": ("ボク", "のだ"),
+    "Agent[04]": ("ワタクシ", "ですわ", "ますわ", "かしら"),
+    "Agent[05]": ("俺", "オレ", "やで", "やろ", "まっせ"),
+}
+MENTION = re.compile(r"Agent\[0\d\]")
+# 繰り返しを調べる直近の発話の数
+WINDOW = 20
+
+
+@dataclass
+class Context:
+    """What the score of a candidate depends on, prepared once for all the candidates."""
+
+    idx: str
+    dead: frozenset[str]
+    markers: tuple[str, ...]
+    recent: list[set[str]]  # 直近の発話の文字bigram
+
+
+Score = Callable[[str, Context], float]
+
+
+def bigrams(text: str) -> set[str]:
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+def make_context(system_call: dict[str, str], chat_history: Iterable[dict[str, str | int]] = (), window: int = WINDOW) -> Context:
+    idx = system_call.get("idx", "")
+    dead = frozenset(MENTION.findall(system_call.get("dead", "")))
+    talks = chat_history[-window:] if isinstance(chat_history, list) else list(chat_history)[-window:]
+    return Context(idx, dead, PERSONA_MARKERS.get(idx, ()), [bigrams(str(talk["text"])) for talk in talks])
+
+
+def score(text: str, context: Context) -> float:
+    """Default score of a candidate. Higher is better.
+
+    - length outside MIN_CHARS..MAX_CHARS costs per character
+    - each forbidden character or word costs 1, an "Agent[0X]: " prefix costs 3
+    - each mention of a dead agent costs 2
+    - the persona's style markers give up to 2
+    - similarity to a recent talk costs up to 4
+    """
+    text = text.strip()
+    if not text or text == "Timeout":
+        return float("-inf")
+    value = 0.0
+    if len(text) < MIN_CHARS:
+        value -= (MIN_CHARS - len(text)) / MIN_CHARS
+    elif len(text) > MAX_CHARS:
+        value -= (len(text) - MAX_CHARS) / 10
+    value -= len(text) - len(text.translate(FORBIDDEN_CHARS))
+    value -= sum(text.count(word) for word in FORBIDDEN_WORDS)
+    if AGENT_PREFIX.match(text):
+        value -= 3
+    if context.dead:
+        value -= 2 * sum(mention in context.dead for mention in MENTION.findall(text))
+    if context.markers:
+        value += 2 * sum(marker in text for marker in context.markers) / len(context.markers)
+    grams = bigrams(text)
+    similarities = [len(grams & recent) / len(grams | recent) for recent in context.recent if recent]
+    if grams and similarities:
+        value -= 4 * max(similarities)
+    return value
+
+
+def choose(
+    candidates: list[str],
+    system_call: dict[str, str],
+    chat_history: Iterable[dict[str, str | int]] = (),
+    score: Score = score,
+) -> Optional[str]:
+    """Best of the candidates by score, or None when there are none. Ties keep the earlier one."""
+    if not candidates:
+        return None
+    if len(candidates) == 1:
+        return candidates[0]
+    context = make_context(system_call, chat_history)
+    return max(candidates, key=lambda text: score(text, context))
@@ -0,0 +1,144 @@
+import json
+import re
+import socket
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+import httpx
+
+SENTENCE_END = re.compile(r"[。！？]")
+# 読み込みが止まっている間に締め切りと取り消しを確かめる間隔(秒)
+WATCH_INTERVAL = 0.05
+
+
+def iter_sse_data(response: httpx.Response) -> Iterator[dict]:
+    """Yield the JSON payload of each server-sent event.
+
+    Args:
+        response (httpx.Response): streaming response
+
+    Yields:
+        dict: payload of a `data:` line. Stops at `data: [DONE]`.
+    """
+    for line in response.iter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        if data:
+            yield json.loads(data)
+
+
+def first_sentence(
+    deltas: Iterator[str],
+    deadline: Optional[float] = None,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+) -> str:
+    """Consume text deltas until the first complete Japanese sentence is available.
+
+    Args:
+        deltas (Iterator[str]): text fragments in the order they were generated
+        deadline (Optional[float], optional): time.monotonic() after which generation is abandoned. Defaults to None.
+        is_cancelled (Optional[Callable[[], bool]], optional): returns True when the caller no longer needs the result. Defaults to None.
+
+    Returns:
+        str: text up to and including the first 。/！/？, the whole text if the stream ended first,
+            or "Timeout" if the deadline passed or the caller cancelled before a sentence was complete.
+    """
+    text = ""
+    for delta in deltas:
+        text += delta
+        # 改行は出力に含めないので, 1文目の判定でも無視する
+        text = text.replace("\n", "")
+        match = SENTENCE_END.search(text)
+        if match:
+            return text[: match.end()]
+        if (deadline is not None and time.monotonic() > deadline) or (is_cancelled and is_cancelled()):
+            return "Timeout"
+    return text if text else "Timeout"
+
+
+def stream_first_sentence(
+    client: httpx.Client,
+    url: str,
+    headers: dict[str, str],
+    payload: dict,
+    get_delta: Callable[[dict], str],
+    timeout: float,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+) -> str:
+    """POST a streaming request and stop reading as soon as one sentence is complete.
+
+    Leaving the `with` block closes the connection, so the provider stops generating tokens we would discard.
+
+    Args:
+        client (httpx.Client): pooled client
+        url (str): endpoint that answers with server-sent events
+        headers (dict[str, str]): request headers
+        payload (dict): request body
+        get_delta (Callable[[dict], str]): extracts the text fragment from one event
+        timeout (float): seconds allowed for the first sentence once the headers have arrived.
+            Connecting and waiting for the headers are only bounded by the httpx timeout,
+            which allows this many seconds for each of them and is not cut by is_cancelled.
+        is_cancelled (Optional[Callable[[], bool]], optional): checked after every event and, while
+            no event arrives, every WATCH_INTERVAL seconds. Defaults to None.
+
+    Returns:
+        str: see first_sentence
+    """
+    deadline = time.monotonic() + timeout
+    with client.stream("POST", url, headers=headers, json=payload, timeout=timeout) as response:
+        response.raise_for_status()
+        # first_sentenceは差分が届いた時にしか締め切りを確かめないので, 止まったストリームは別スレッドで切る
+        done = threading.Event()
+        interrupted = threading.Event()
+        watcher = threading.Thread(
+            target=watch, args=(response, deadline, is_cancelled, done, interrupted), daemon=True
+        )
+        watcher.start()
+        try:
+            text = first_sentence(
+                (get_delta(event) for event in iter_sse_data(response)), deadline, is_cancelled
+            )
+            # 切った接続は途中で終わったストリームに見える
+            return "Timeout" if interrupted.is_set() else text
+        except httpx.HTTPError:
+            if interrupted.is_set():
+                return "Timeout"
+            raise
+        finally:
+            done.set()
+
+
+def watch(
+    response: httpx.Response,
+    deadline: float,
+    is_cancelled: Optional[Callable[[], bool]],
+    done: threading.Event,
+    interrupted: threading.Event,
+) -> None:
+    """Interrupt the read of response once the deadline passes or the caller cancels."""
+    while not done.wait(min(max(deadline - time.monotonic(), 0), WATCH_INTERVAL)):
+        if time.monotonic() >= deadline or (is_cancelled and is_cancelled()):
+            interrupted.set()
+            interrupt(response)
+            return
+
+
+def interrupt(response: httpx.Response) -> None:
+    """Wake up a read blocked on the response's socket.
+
+    Closing a socket does not wake a recv in another thread, but shutting it down does.
+    HTTP/2 responses do not expose their socket and are closed instead.
+    """
+    stream = response.extensions.get("network_stream")
+    sock = stream.get_extra_info("socket") if stream is not None else None
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        else:
+            response.close()
+    except Exception:
+        pass
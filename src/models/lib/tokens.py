@@ -0,0 +1,75 @@
+import hashlib
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Sequence
+
+ENCODING = "cl100k_base"
+# tiktokenのBPEファイルを置くディレクトリ. ここにあればネットワークに取りに行かない
+CACHE_DIR = Path(__file__).resolve().parent / "tiktoken_cache"
+BLOB_URL = "https://openaipublic.blob.core.windows.net/encodings/{}.tiktoken"
+
+
+def cache_file(name: str = ENCODING) -> Path:
+    """Path tiktoken reads the BPE ranks of the encoding from when TIKTOKEN_CACHE_DIR is CACHE_DIR."""
+    return CACHE_DIR / hashlib.sha1(BLOB_URL.format(name).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = ENCODING):
+    """Load the encoding once per process from the bundled cache.
+
+    Returns None when tiktoken or the cached file is not available, in which case
+    count_tokens falls back to an estimate instead of downloading on the request path.
+    """
+    if not cache_file(name).exists():
+        return None
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(CACHE_DIR))
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+def count_text(text: str) -> int:
+    """Number of tokens in text."""
+    encoding = get_encoding()
+    if encoding is None:
+        # cl100k_baseでは日本語はおおむね1文字1トークン
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=65536)
+def count_tokens(text: str) -> int:
+    """count_text memoized for short texts such as utterances that are counted again and again."""
+    return count_text(text)
+
+
+def fit_newest(lines: Sequence[str], budget: Optional[int]) -> list[str]:
+    """Keep the newest lines whose total fits in budget. None keeps every line."""
+    if budget is None:
+        return list(lines)
+    kept = len(lines)
+    for line in reversed(lines):
+        budget -= count_tokens(line)
+        if budget < 0:
+            break
+        kept -= 1
+    return list(lines[kept:])
+
+
+def main() -> None:
+    """Download the BPE file of the encoding into CACHE_DIR so the agents never fetch it at runtime."""
+    os.environ["TIKTOKEN_CACHE_DIR"] = str(CACHE_DIR)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    import tiktoken
+
+    tiktoken.get_encoding(ENCODING)
+    print(f"saved {cache_file()}")
+
+
+if __name__ == "__main__":
+    main()
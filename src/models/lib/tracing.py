@@ -0,0 +1,81 @@
+import contextvars
+import os
+import threading
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Optional
+
+_tracer = None
+_noop = nullcontext()
+_context: contextvars.ContextVar[dict[str, Any]] = contextvars.ContextVar("tracing_context", default={})
+
+
+def configure(exporter: str = "", path: str = "logs/spans.jsonl", endpoint: Optional[str] = None, service: str = "aiwolf-agent") -> None:
+    """Enable tracing. Spans are not recorded until this is called with an exporter.
+
+    Args:
+        exporter (str, optional): "file" writes one JSON span per line to path, "otlp" sends to an
+            OTLP/gRPC collector, "" keeps tracing disabled. Defaults to "".
+        path (str, optional): output of the file exporter. Defaults to "logs/spans.jsonl".
+        endpoint (Optional[str], optional): OTLP collector such as "localhost:4317". Defaults to None.
+        service (str, optional): service.name resource attribute. Defaults to "aiwolf-agent".
+    """
+    global _tracer
+    if not exporter or _tracer is not None:
+        return
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    if exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+        span_exporter = OTLPSpanExporter(endpoint=endpoint, insecure=True)
+    else:
+        span_exporter = _file_exporter(path)
+    provider = TracerProvider(resource=Resource.create({"service.name": service}))
+    provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    _tracer = provider.get_tracer(__name__)
+
+
+def _file_exporter(path: str):
+    from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+    class FileSpanExporter(SpanExporter):
+        """Appends spans as JSON lines. Each process writes its own file."""
+
+        def __init__(self) -> None:
+            self.lock = threading.Lock()
+
+        def export(self, spans) -> SpanExportResult:
+            file = Path(path)
+            file = file.with_name(f"{file.stem}-{os.getpid()}{file.suffix}")
+            file.parent.mkdir(parents=True, exist_ok=True)
+            with self.lock, open(file, "a", encoding="utf-8") as f:
+                for span in spans:
+                    f.write(span.to_json(indent=None) + "\n")
+            return SpanExportResult.SUCCESS
+
+        def shutdown(self) -> None:
+            pass
+
+    return FileSpanExporter()
+
+
+def set_context(**attributes: Any) -> None:
+    """Attributes such as game, day, agent and request added to every following span and record."""
+    _context.set({**_context.get(), **attributes})
+
+
+def context() -> dict[str, Any]:
+    """Attributes set by set_context in the current task."""
+    return _context.get()
+
+
+def span(name: str, **attributes: Any) -> ContextManager:
+    """Nested span. Costs one global lookup when tracing is disabled."""
+    if _tracer is None:
+        return _noop
+    return _tracer.start_as_current_span(
+        name, attributes={key: value for key, value in {**_context.get(), **attributes}.items() if value is not None}
+    )
@@ -1,29 +1,19 @@
-import logging
 import os
-import re
-from datetime import datetime
-from pathlib import Path
-from typing import Any
 
 import google.generativeai as genai
 import openai
-import tiktoken
 from loguru import logger
+from src.models.lib.history import ChatHistory, format_talk
+from src.models.lib.names import mention
+from src.models.lib.normalize import DEFAULT as DEFAULT_NORMALIZER
+from src.models.lib.normalize import NON_DIGIT
 from src.models.lib.prompt import GET_BEST_QUOLITY_PROMPT
+from src.models.lib.tokens import count_text
 
 
 def normalize_text(text: str) -> str:
-    """Normalize the text."""
-    text = re.sub(r"「|」", "", text)
-    text = re.sub(r"；|;", "", text)
-    text = re.sub(r":|：", "", text)
-    text = re.sub(r"’|'", "", text)
-    text = re.sub(r"　", "", text)      # 全角を削除
-    text = re.sub(r"\(|\)", "", text)
-    text = re.sub(r"XXX", "", text)
-    text = re.sub(r"♪", "", text)
-    text = re.sub(r'\.', '。', text)
-    return text
+    """Normalize the text. See normalize.Normalizer for the rules."""
+    return DEFAULT_NORMALIZER(text)
 
 
 def make_unified_prompt_from_list(responses: list[str]) -> str:
@@ -45,22 +35,25 @@ def check_towards_me(
     Returns:
         dict[str, str] | None: Dictionary that contains the agent and the text if the chat history is directed towards me, otherwise None
     """
-    my_idx: int = re.sub(r"\D", "", index_sentence)[1]
+    my_idx: int = NON_DIGIT.sub("", index_sentence)[1]
     for chat in chat_history:
-        if f">>Agent[0{my_idx}]" in chat["text"]:
+        if mention(my_idx) in chat["text"]:
             return {"from": chat["agent"], "text": chat["text"]}
     return None
 
 
-def get_until_today_history(chat_history: list[dict[str, str]]) -> str:
+def get_until_today_history(chat_history: list[dict[str, str]] | ChatHistory) -> str:
     """Get the chat history for each day.
 
     Args:
-        chat_history (list[dict[str, str]]): list of chat history.
+        chat_history (list[dict[str, str]] | ChatHistory): list of chat history.
+            A ChatHistory returns its cached rendering.
 
     Returns:
         str: chat history for each day with markdown format.
     """
+    if isinstance(chat_history, ChatHistory):
+        return chat_history.render()
     today: int = chat_history[-1]["day"]
     until_today_history: str = ""
     for day in range(today + 1):
@@ -81,74 +74,7 @@ def get_chat_history(chat_history: list[dict[str, str]]) -> str:
     Returns:
         str: chat history that is be concatenated with the role and message
     """
-    concatenated_history: str = ""
-    for chat in chat_history:
-        concatenated_history += f"Agent[0{chat['agent']}]: {chat['text']}\n"
-    return concatenated_history
-
-
-def output_log(
-    model: str,
-    response: Any,
-    elapsed_time: float,
-    prompts: list[dict[str, str]],
-    output: str,
-) -> None:
-    """Output log to the log file.
-
-    Args:
-        model (str): "gemini-pro", "gpt-3.5-turbo" or "gpt-4"
-        response (Any): response from the model
-        elapsed_time (float): elapsed time for the response
-        prompts (list[str]): list of prompts
-        output (str): output from the model
-    """
-    log_path = Path("logs")
-    log_path.mkdir(parents=True, exist_ok=True)
-    log_file = log_path / f"{datetime.now().strftime('%Y-%m-%d-%H:%M')}.log"
-
-    logging.basicConfig(filename=log_file, level=logging.INFO, format="")
-
-    if model == "gemini-pro":
-        logging.info("model: gemini-pro")
-        logging.info("costs: $0")
-        logging.info(f"elapsed_time: {elapsed_time:.3f} sec")
-        logging.info(f"prompts:")
-        if isinstance(prompts, list):
-            for prompt in prompts:
-                logging.info(prompt)
-        else:
-            # prompts is a string
-            logging.info(prompts)
-        logging.info(f"output: {output}")
-    else:
-        costs: float = 0.0
-        total_tokens = response.usage.total_tokens
-        logging.info(f"model: {model}")
-        logging.info(f"total_tokens: {total_tokens}")
-        logging.info(f"elapsed_time: {elapsed_time:.3f} sec")
-        if model == "gpt-3.5-turbo":
-            costs = total_tokens * 0.0015 / 1000
-            logging.info(f"costs: ${costs}")
-        else:
-            costs = total_tokens * 0.06 / 1000
-            logging.info(f"costs: {costs}")
-        logging.info(f"prompts:")
-        if isinstance(prompts, list):
-            (
-                user_counts,
-                system_counts,
-                assistant_counts,
-                overall_counts,
-            ) = num_tokens_from_string(prompts)
-            logging.info(f"user_num_tokens: {user_counts}")
-            logging.info(f"system_num_tokens: {system_counts}")
-            logging.info(f"assistant_num_tokens: {assistant_counts}")
-            logging.info(f"overall_intput_num_tokens: {overall_counts}")
-        else:
-            # prompts is a string
-            logging.info(prompts)
-        logging.info(f"output: {output}")
+    return "".join(format_talk(chat) for chat in chat_history)
 
 
 def list_google_model() -> None:
@@ -170,20 +96,23 @@ def list_openai_model() -> None:
 def num_tokens_from_string(
     messages: list[dict[str, str]], model_name: str = "gpt-4-0125-preview"
 ) -> tuple[int, int, int, int]:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.encoding_for_model(model_name)
+    """Returns the number of tokens in a text string.
+
+    model_name is kept for compatibility. Every model counted here uses cl100k_base,
+    which is loaded once from the bundled cache.
+    """
     user_num_tokens = sum(
-        len(encoding.encode(message["content"]))
+        count_text(message["content"])
         for message in messages
         if message["role"] == "user"
     )
     system_num_tokens = sum(
-        len(encoding.encode(message["content"]))
+        count_text(message["content"])
         for message in messages
         if message["role"] == "system"
     )
     assistant_num_tokens = sum(
-        len(encoding.encode(message["content"]))
+        count_text(message["content"])
         for message in messages
         if message["role"] == "assistant"
     )
@@ -0,0 +1,269 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from src.agent.lib import template
+from src.models.lib.names import name
+
+
+@dataclass
+class Latency:
+    """Latency distribution such as "fixed:0.5", "uniform:0.2,1.0", "lognormal:-0.7,0.4" or "exp:0.5"."""
+
+    kind: str = "fixed"
+    params: tuple[float, ...] = (0.0,)
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        kind, _, params = spec.partition(":")
+        return cls(kind, tuple(float(param) for param in params.split(",") if param))
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "lognormal":
+            return rng.lognormvariate(*self.params)
+        if self.kind == "exp":
+            return rng.expovariate(1 / self.params[0])
+        return self.params[0]
+
+
+@dataclass
+class MockConfig:
+    latency: Latency = field(default_factory=Latency)
+    chunk_delay: float = 0.02  # ストリーミング時のチャンク間隔
+    chunk_size: int = 4
+    errors: dict[int, float] = field(default_factory=dict)  # ステータスコード -> 発生確率
+    hang_rate: float = 0.0  # 応答せずに止まる確率
+    hang: float = 10.0
+    responses: list[str] = field(default_factory=list)  # 台本. 空ならtemplate.pyから作る
+    seed: Optional[int] = None
+
+
+class MockProvider:
+    """Builds the answers of the mock server."""
+
+    def __init__(self, config: MockConfig) -> None:
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def fault(self) -> tuple[int, float]:
+        """Returns the status code to answer with and the delay before the first byte."""
+        with self.lock:
+            if self.rng.random() < self.config.hang_rate:
+                return 200, self.config.hang
+            roll = self.rng.random()
+            for status, rate in self.config.errors.items():
+                if roll < rate:
+                    return status, self.config.latency.sample(self.rng)
+                roll -= rate
+            return 200, self.config.latency.sample(self.rng)
+
+    def answer(self, prompt: str) -> str:
+        with self.lock:
+            self.count += 1
+            if self.config.responses:
+                return self.config.responses[(self.count - 1) % len(self.config.responses)]
+            return self.from_template(prompt)
+
+    def from_template(self, prompt: str) -> str:
+        """Answer in the format the prompt asks for, using the fixed utterances of template.py."""
+        agents = [int(agent) for agent in re.findall(r"Agent\[0(\d)\]", prompt) if agent != "0" and agent != "6"]
+        agents = agents or [1, 2, 3, 4, 5]
+        if "投票しようとしている人物" in prompt:
+            return f"{name(self.rng.choice(agents))} -> {name(self.rng.choice(agents))}" if self.rng.random() < 0.5 else "None"
+        if "占いに関わる発話を探し" in prompt:
+            report = self.rng.choice(["白", "黒"])
+            return f"{name(self.rng.choice(agents))}, {name(self.rng.choice(agents))}, {report}" if self.rng.random() < 0.3 else "None"
+        if "対象者は" in prompt:
+            targets = re.findall(r"Agent\[0\d\]", prompt.split("対象者は")[-1])
+            return self.rng.choice(targets) if targets else "Agent[01]"
+        if "最も返答として適切なもの" in prompt:
+            candidates = re.findall(r"- \d+\n(.*)\n", prompt)
+            return self.rng.choice(candidates) if candidates else ""
+        me = re.search(r"あなたはAgent\[0(\d)\]です", prompt)
+        idx = int(me.group(1)) if me else 0
+        utterances = [
+            template.DAY1_MORNING[idx],
+            template.DAY2_MORNING[idx],
+            template.DAY1_EVENING[idx],
+            template.SEER_DECLARE[idx].format(self.rng.choice(agents), self.rng.choice(["人間", "人狼"])),
+            template.VOTE_INQUIRE[idx].format(self.rng.choice(agents)).split(" ", 1)[1],
+            template.WEREWOLF_DECLARE[idx].format(self.rng.choice(agents)),
+        ]
+        return self.rng.choice(utterances)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    provider: MockProvider
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+        status, delay = self.provider.fault()
+        time.sleep(delay)
+        if status != 200:
+            self.send_json(status, {"error": {"code": status, "message": "injected failure"}})
+            return
+        if path.endswith("/chat/completions"):
+            self.openai(body)
+        elif path.endswith(":generateContent") or path.endswith(":streamGenerateContent"):
+            self.gemini(body, path.endswith(":streamGenerateContent"), path.split("/")[-1].split(":")[0])
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"unknown path {path}"}})
+
+    def openai(self, body: dict) -> None:
+        prompt = "\n".join(message["content"] for message in body.get("messages", []))
+        answers = [self.provider.answer(prompt) for _ in range(body.get("n") or 1)]
+        model = body.get("model", "gpt-3.5-turbo")
+        if body.get("stream"):
+            events = [
+                {"object": "chat.completion.chunk", "model": model, "choices": [{"index": index, "delta": {"content": chunk}}]}
+                for index, answer in enumerate(answers)
+                for chunk in self.chunks(answer)
+            ]
+            self.send_events(events, done=True)
+            return
+        self.send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {"index": index, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+                for index, answer in enumerate(answers)
+            ],
+            "usage": {
+                "prompt_tokens": len(prompt),
+                "completion_tokens": sum(len(answer) for answer in answers),
+                "total_tokens": len(prompt) + sum(len(answer) for answer in answers),
+            },
+        })
+
+    def gemini(self, body: dict, stream: bool, model: str) -> None:
+        contents = body.get("contents", [])
+        contents = contents if isinstance(contents, list) else [contents]
+        prompt = "\n".join(
+            part["text"]
+            for content in contents
+            for part in (content["parts"] if isinstance(content["parts"], list) else [content["parts"]])
+        )
+        count = (body.get("generation_config") or {}).get("candidate_count") or 1
+        answers = [self.provider.answer(prompt) for _ in range(count)]
+        if stream:
+            events = [
+                {"candidates": [{"index": index, "content": {"role": "model", "parts": [{"text": chunk}]}}]}
+                for index, answer in enumerate(answers)
+                for chunk in self.chunks(answer)
+            ]
+            self.send_events(events, done=False)
+            return
+        self.send_json(200, {
+            "candidates": [
+                {"index": index, "content": {"role": "model", "parts": [{"text": answer}]}, "finishReason": "STOP"}
+                for index, answer in enumerate(answers)
+            ],
+            "modelVersion": model,
+        })
+
+    def chunks(self, text: str) -> list[str]:
+        size = self.provider.config.chunk_size
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def send_json(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_events(self, events: list[dict], done: bool) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for event in events:
+                self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(self.provider.config.chunk_delay)
+            if done:
+                self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアントが1文目で読み込みを打ち切った
+            pass
+
+
+def serve(config: MockConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Start the mock server in a background thread.
+
+    Args:
+        config (MockConfig): latency, failure and response settings
+        host (str, optional): address to bind. Defaults to "127.0.0.1".
+        port (int, optional): port to bind. 0 picks a free port. Defaults to 0.
+
+    Returns:
+        ThreadingHTTPServer: running server. server.server_address gives the bound port.
+    """
+    handler = type("Handler", (MockHandler,), {"provider": MockProvider(config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="OpenAI/Gemini互換のモックサーバ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", default="fixed:0.3", help='例: "uniform:0.2,1.0", "lognormal:-1.0,0.5", "exp:0.5"')
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--errors", default="", help='例: "429:0.05,500:0.02"')
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--hang", type=float, default=10.0)
+    parser.add_argument("--responses", default=None, help="1行1応答の台本ファイル")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    responses = []
+    if args.responses:
+        with open(args.responses, encoding="utf-8") as f:
+            responses = [line.rstrip("\n") for line in f if line.strip()]
+    config = MockConfig(
+        latency=Latency.parse(args.latency),
+        chunk_delay=args.chunk_delay,
+        errors={int(status): float(rate) for status, rate in (item.split(":") for item in args.errors.split(",") if item)},
+        hang_rate=args.hang_rate,
+        hang=args.hang,
+        responses=responses,
+        seed=args.seed,
+    )
+    server = serve(config, args.host, args.port)
+    print(f"mock server listening on http://{args.host}:{server.server_address[1]}")
+    print(f"  OPENAI_BASE_URL=http://{args.host}:{server.server_address[1]}/v1")
+    print(f"  GEMINI_BASE_URL=http://{args.host}:{server.server_address[1]}/v1beta")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import json
+import random
+import socket
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+ROLES = ["VILLAGER", "VILLAGER", "SEER", "POSSESSED", "WEREWOLF"]
+
+# (request, day, talk_turn, agent, elapsed, timed_out)
+ResponseHook = Callable[[str, int, int, int, float, bool], None]
+
+
+class Player:
+    """One agent connection. Requests are JSON lines, responses are text lines."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.buffer = b""
+        self.stale = 0  # 締め切り後に届く予定の応答の数
+        self.name = ""
+
+    def send(self, packet: dict) -> None:
+        self.sock.sendall((json.dumps(packet, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"))
+
+    def readline(self, deadline: float) -> Optional[str]:
+        while b"\n" not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                return None
+            if chunk == b"":
+                raise ConnectionError("agent disconnected")
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode("utf-8")
+
+    def request(self, packet: dict, timeout: float) -> tuple[Optional[str], float]:
+        """Send a request that expects an answer.
+
+        Returns:
+            tuple[Optional[str], float]: answer (None on timeout) and elapsed seconds
+        """
+        start = time.monotonic()
+        self.send(packet)
+        deadline = start + timeout
+        # 前の要求に遅れて届いた応答は読み捨てる
+        while self.stale:
+            if self.readline(deadline) is None:
+                break
+            self.stale -= 1
+        line = self.readline(deadline) if not self.stale else None
+        if line is None:
+            self.stale += 1
+        return line, time.monotonic() - start
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class Game:
+    """5-player AIWolf game driven over the NL protocol.
+
+    Args:
+        players (list[Player]): connected agents. Agent indices are 1-origin in this order.
+        rng (random.Random): decides roles, ties and answers of agents that timed out
+        timeout (float): seconds each agent has to answer a request
+        max_talk_turn (int): talk rounds per day at most
+        on_response (Optional[ResponseHook]): called after every answered or timed out request
+    """
+
+    def __init__(
+        self,
+        players: list[Player],
+        rng: random.Random,
+        timeout: float = 5.0,
+        max_talk_turn: int = 10,
+        on_response: Optional[ResponseHook] = None,
+    ) -> None:
+        self.players = players
+        self.rng = rng
+        self.timeout = timeout
+        self.max_talk_turn = max_talk_turn
+        self.on_response = on_response
+        roles = list(ROLES)
+        rng.shuffle(roles)
+        self.roles = {idx: role for idx, role in enumerate(roles, start=1)}
+        self.alive = set(self.roles)
+        self.day = 0
+        self.divine_result: Optional[dict] = None
+        self.executed: Optional[int] = None
+        self.attacked: Optional[int] = None
+        self.talks: list[dict] = []
+        self.sent = {idx: 0 for idx in self.roles}  # 各エージェントに送った発話履歴の位置
+        self.setting = {
+            "playerNum": len(players),
+            "roleNumMap": dict(Counter(ROLES)),
+            "maxTalkTurn": max_talk_turn,
+            "responseTimeout": int(timeout * 1000),
+        }
+
+    def game_info(self, idx: int, reveal: bool = False) -> dict:
+        role = self.roles[idx]
+        role_map = {str(agent): r for agent, r in self.roles.items() if reveal or agent == idx or (role == "WEREWOLF" and r == "WEREWOLF")}
+        return {
+            "day": self.day,
+            "agent": idx,
+            "roleMap": role_map,
+            "statusMap": {str(agent): "ALIVE" if agent in self.alive else "DEAD" for agent in self.roles},
+            "divineResult": self.divine_result if role == "SEER" else None,
+            "executedAgent": self.executed,
+            "attackedAgent": self.attacked,
+        }
+
+    def packet(self, request: str, idx: int, with_info: bool = True, reveal: bool = False) -> dict:
+        history = self.talks[self.sent[idx]:]
+        self.sent[idx] = len(self.talks)
+        return {
+            "request": request,
+            "gameInfo": self.game_info(idx, reveal) if with_info else None,
+            "gameSetting": self.setting if request == "INITIALIZE" else None,
+            "talkHistory": history,
+            "whisperHistory": [],
+        }
+
+    def notify(self, request: str, targets=None, reveal: bool = False) -> None:
+        for idx in targets or self.roles:
+            self.players[idx - 1].send(self.packet(request, idx, reveal=reveal))
+
+    def ask(self, request: str, idx: int, turn: int = 0) -> Optional[str]:
+        answer, elapsed = self.players[idx - 1].request(self.packet(request, idx), self.timeout)
+        if self.on_response:
+            self.on_response(request, self.day, turn, idx, elapsed, answer is None)
+        return answer
+
+    def ask_target(self, request: str, idx: int, candidates: list[int]) -> int:
+        answer = self.ask(request, idx)
+        try:
+            target = int(json.loads(answer)["agentIdx"])
+        except Exception:
+            target = None
+        return target if target in candidates else self.rng.choice(candidates)
+
+    def run(self) -> str:
+        """Play one game and return the winning side ("VILLAGER" or "WEREWOLF")."""
+        for idx, player in enumerate(self.players, start=1):
+            name = self.ask("NAME", idx)
+            player.name = name or f"Agent[0{idx}]"
+        self.notify("INITIALIZE")
+        winner = None
+        while winner is None:
+            self.notify("DAILY_INITIALIZE")
+            self.talk()
+            self.notify("DAILY_FINISH")
+            if self.day > 0:
+                self.executed = self.vote()
+                self.alive.discard(self.executed)
+                winner = self.judge()
+                if winner:
+                    break
+            self.divine()
+            if self.day > 0:
+                self.attacked = self.attack()
+                self.alive.discard(self.attacked)
+                winner = self.judge()
+            self.day += 1
+        self.notify("FINISH", reveal=True)
+        return winner
+
+    def talk(self) -> None:
+        for turn in range(self.max_talk_turn):
+            over = 0
+            for idx in sorted(self.alive):
+                text = self.ask("TALK", idx, turn) or "Skip"
+                over += text == "Over"
+                self.talks.append({"idx": len(self.talks), "day": self.day, "turn": turn, "agent": idx, "text": text})
+            if over == len(self.alive):
+                break
+
+    def vote(self) -> int:
+        votes = Counter()
+        for idx in sorted(self.alive):
+            votes[self.ask_target("VOTE", idx, sorted(self.alive - {idx}))] += 1
+        top = max(votes.values())
+        return self.rng.choice([agent for agent, count in votes.items() if count == top])
+
+    def divine(self) -> None:
+        seers = [idx for idx in self.alive if self.roles[idx] == "SEER"]
+        self.divine_result = None
+        for seer in seers:
+            target = self.ask_target("DIVINE", seer, sorted(self.alive - {seer}))
+            result = "WEREWOLF" if self.roles[target] == "WEREWOLF" else "HUMAN"
+            self.divine_result = {"day": self.day, "agent": seer, "target": target, "result": result}
+
+    def attack(self) -> int:
+        wolves = [idx for idx in self.alive if self.roles[idx] == "WEREWOLF"]
+        candidates = sorted(idx for idx in self.alive if self.roles[idx] != "WEREWOLF")
+        return self.ask_target("ATTACK", wolves[0], candidates)
+
+    def judge(self) -> Optional[str]:
+        wolves = sum(self.roles[idx] == "WEREWOLF" for idx in self.alive)
+        if wolves == 0:
+            return "VILLAGER"
+        if wolves >= len(self.alive) - wolves:
+            return "WEREWOLF"
+        return None
@@ -0,0 +1,78 @@
+import argparse
+import configparser
+import random
+import socket
+import time
+from collections import Counter
+
+from src.server.game import Game, Player
+
+
+def connect_players(inifile: configparser.ConfigParser, listen_port: int, retry_seconds: float = 30.0) -> list[Player]:
+    """Connect to the agents the same way the Java game server does.
+
+    When host_flag is true the agents listen (TCPServer) on [tcp-server] port1..portN and
+    this server connects to them. Otherwise the agents connect (TCPClient) to listen_port.
+    """
+    agent_num = inifile.getint("agent", "num")
+    if inifile.getboolean("connection", "host_flag"):
+        host = inifile.get("tcp-server", "ip")
+        players = []
+        for i in range(agent_num):
+            port = inifile.getint("tcp-server", f"port{i + 1}")
+            deadline = time.monotonic() + retry_seconds
+            while True:
+                try:
+                    players.append(Player(socket.create_connection((host, port))))
+                    break
+                except ConnectionRefusedError:
+                    # エージェントの起動を待つ
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.2)
+        return players
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("", listen_port))
+    server.listen()
+    print(f"game server listening... port:{listen_port}")
+    players = [Player(server.accept()[0]) for _ in range(agent_num)]
+    server.close()
+    return players
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Java版サーバを使わずに自己対戦を行うゲームサーバ")
+    parser.add_argument("--config", default="./src/agent/config.ini")
+    parser.add_argument("--games", type=int, default=None, help="対戦数. 省略時は[game] num")
+    parser.add_argument("--timeout", type=float, default=5.0, help="エージェントが応答するまでの制限時間(秒)")
+    parser.add_argument("--max-talk-turn", type=int, default=10)
+    parser.add_argument("--port", type=int, default=10000, help="host_flag = falseの場合に待ち受けるポート")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    inifile = configparser.ConfigParser()
+    inifile.read(args.config, "UTF-8")
+    games = args.games or inifile.getint("game", "num")
+    rng = random.Random(args.seed)
+
+    players = connect_players(inifile, args.port)
+    winners = Counter()
+    timeouts = Counter()
+
+    def on_response(request: str, day: int, turn: int, agent: int, elapsed: float, timed_out: bool) -> None:
+        if timed_out:
+            timeouts[request] += 1
+
+    for game_num in range(games):
+        winner = Game(players, rng, args.timeout, args.max_talk_turn, on_response).run()
+        winners[winner] += 1
+        print(f"game {game_num + 1}/{games}: {winner} win")
+    for player in players:
+        player.close()
+    print(f"winners: {dict(winners)} timeouts: {dict(timeouts)}")
+
+
+if __name__ == "__main__":
+    main()